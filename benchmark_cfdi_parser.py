@@ -0,0 +1,96 @@
+"""
+Compare the lxml single-pass CFDI extraction in cfdi_parser with the
+ElementTree find/findall code the integrations used before.
+
+    python benchmark_cfdi_parser.py [directory] [rounds]
+
+Defaults to every XML under Inputs/ and 20 rounds. Both parsers are also
+checked to extract the same data from every file.
+"""
+import os
+import sys
+import time
+import xml.etree.ElementTree as ET
+
+from cfdi_parser import parse_cfdi
+
+ns = {
+    'cfdi': 'http://www.sat.gob.mx/cfd/4',
+    'tfd': 'http://www.sat.gob.mx/TimbreFiscalDigital'
+}
+
+
+def parse_with_elementtree(file_path):
+    """The previous extraction: full ET.parse plus nested find/findall lookups."""
+    tree = ET.parse(file_path)
+    root = tree.getroot()
+    if root.attrib.get('TipoDeComprobante') != 'I':
+        return None
+
+    conceptos = []
+    for concepto in root.find('cfdi:Conceptos', ns).findall('cfdi:Concepto', ns):
+        traslados = []
+        impuestos = concepto.find('cfdi:Impuestos', ns)
+        if impuestos is not None:
+            traslados_node = impuestos.find('cfdi:Traslados', ns)
+            if traslados_node is not None:
+                for traslado in traslados_node.findall('cfdi:Traslado', ns):
+                    if 'TasaOCuota' in traslado.attrib:
+                        traslados.append((traslado.attrib['Impuesto'], float(traslado.attrib['TasaOCuota']), float(traslado.attrib['Importe'])))
+        conceptos.append({
+            'descripcion': concepto.attrib['Descripcion'],
+            'cantidad': float(concepto.attrib['Cantidad']),
+            'valor_unitario': float(concepto.attrib['ValorUnitario']),
+            'traslados': traslados,
+        })
+
+    return {
+        'tipo': root.attrib.get('TipoDeComprobante'),
+        'fecha': root.attrib['Fecha'],
+        'folio': root.attrib.get('Folio', 'N/A'),
+        'total': float(root.attrib['Total']),
+        'uuid': root.find('.//tfd:TimbreFiscalDigital', ns).attrib.get('UUID', ''),
+        'emisor_nombre': root.find('cfdi:Emisor', ns).attrib['Nombre'],
+        'emisor_rfc': root.find('cfdi:Emisor', ns).attrib['Rfc'],
+        'receptor_nombre': root.find('cfdi:Receptor', ns).attrib.get('Nombre', ''),
+        'uso_cfdi': root.find('cfdi:Receptor', ns).attrib.get('UsoCFDI', ''),
+        'conceptos': conceptos,
+    }
+
+
+def find_xml_files(directory):
+    files = []
+    for root_dir, _, names in os.walk(directory):
+        files.extend(os.path.join(root_dir, name) for name in names if name.endswith('.xml'))
+    return sorted(files)
+
+
+def run(parse, files, rounds):
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for file_path in files:
+            parse(file_path)
+    return time.perf_counter() - started
+
+
+if __name__ == '__main__':
+    directory = sys.argv[1] if len(sys.argv) > 1 else 'Inputs'
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    files = find_xml_files(directory)
+    if not files:
+        sys.exit(f'No XML files found under {directory}')
+
+    for file_path in files:
+        if parse_with_elementtree(file_path) != parse_cfdi(file_path, tipo='I'):
+            sys.exit(f'Parsers disagree on {file_path}')
+
+    # Warm up the OS file cache before timing
+    run(parse_cfdi, files, 1)
+    elementtree_time = run(parse_with_elementtree, files, rounds)
+    lxml_time = run(lambda file_path: parse_cfdi(file_path, tipo='I'), files, rounds)
+
+    documents = len(files) * rounds
+    print(f'{len(files)} files x {rounds} rounds')
+    print(f'ElementTree: {elementtree_time:.3f}s ({documents / elementtree_time:,.0f} docs/s)')
+    print(f'cfdi_parser: {lxml_time:.3f}s ({documents / lxml_time:,.0f} docs/s)')
+    print(f'Speedup: {elementtree_time / lxml_time:.2f}x')
@@ -0,0 +1,59 @@
+"""
+Compare the memory held by parsed invoices as nested dicts (the previous
+representation) and as the slotted invoice_models.Invoice objects.
+
+    python benchmark_invoice_memory.py [directory] [count]
+
+Parses the XMLs under Inputs/ and repeats them up to 10,000 invoices by
+default, then reports the traced peak for each representation and the size
+of the JSON a client would receive.
+"""
+import gc
+import sys
+import json
+import tracemalloc
+
+from benchmark_cfdi_parser import find_xml_files
+from cfdi_parser import parse_cfdi, build_invoice
+
+
+def load_cfdis(directory):
+    cfdis = []
+    for file_path in find_xml_files(directory):
+        cfdi = parse_cfdi(file_path, tipo='I')
+        if cfdi is not None:
+            cfdis.append(cfdi)
+    return cfdis
+
+
+def measure(build, cfdis, count):
+    gc.collect()
+    tracemalloc.start()
+    invoices = [build(cfdis[index % len(cfdis)]) for index in range(count)]
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return invoices, peak
+
+
+def as_dict(cfdi):
+    # What parse_xml_and_get_data_no_zoho used to keep for every invoice
+    return build_invoice(cfdi).to_document()
+
+
+if __name__ == '__main__':
+    directory = sys.argv[1] if len(sys.argv) > 1 else 'Inputs'
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+    cfdis = load_cfdis(directory)
+    if not cfdis:
+        sys.exit(f'No ingreso XML files found under {directory}')
+
+    dicts, dict_peak = measure(as_dict, cfdis, count)
+    del dicts
+    compact, compact_peak = measure(build_invoice, cfdis, count)
+
+    json_size = sum(len(invoice.to_json()) for invoice in compact)
+    print(f'{count} invoices from {len(cfdis)} distinct CFDIs')
+    print(f'dicts:   {dict_peak / 1024 / 1024:.2f} MiB')
+    print(f'Invoice: {compact_peak / 1024 / 1024:.2f} MiB')
+    print(f'Reduction: {dict_peak / compact_peak:.2f}x')
+    print(f'JSON payload: {json_size / 1024 / 1024:.2f} MiB')
@@ -0,0 +1,161 @@
+import logging
+import threading
+from lxml import etree
+from invoice_models import Invoice, LineItem, Tax, intern
+
+# Namespaces of the CFDI 4.0 documents SAT returns
+CFDI_NS = 'http://www.sat.gob.mx/cfd/4'
+TFD_NS = 'http://www.sat.gob.mx/TimbreFiscalDigital'
+
+NAMESPACES = {
+    'cfdi': CFDI_NS,
+    'tfd': TFD_NS,
+}
+
+# Lookups compiled once and bound to the CFDI namespaces
+_EMISOR = etree.XPath('cfdi:Emisor', namespaces=NAMESPACES)
+_RECEPTOR = etree.XPath('cfdi:Receptor', namespaces=NAMESPACES)
+_CONCEPTOS = etree.XPath('cfdi:Conceptos/cfdi:Concepto', namespaces=NAMESPACES)
+_TRASLADOS = etree.XPath('cfdi:Impuestos/cfdi:Traslados/cfdi:Traslado', namespaces=NAMESPACES)
+_TIMBRE = etree.XPath('cfdi:Complemento/tfd:TimbreFiscalDigital', namespaces=NAMESPACES)
+_COMPROBANTE = f'{{{CFDI_NS}}}Comprobante'
+
+# One parser per thread: lxml parsers are not safe to share across threads
+_parsers = threading.local()
+
+# SAT 'Impuesto' codes
+TAX_NAMES = {
+    '001': 'ISR',
+    '002': 'IVA',
+    '003': 'IEPS',
+}
+
+
+class CfdiParseError(Exception):
+    """Raised when a document is not well-formed XML or misses a required CFDI attribute."""
+
+
+def tax_name(impuesto):
+    return TAX_NAMES.get(impuesto, 'Unknown Tax')
+
+
+def concepto_taxes(concepto):
+    """Yield (tax_name, percentage, amount) for the non-zero traslados of a concepto."""
+    for impuesto, tasa_o_cuota, importe in concepto['traslados']:
+        tax_rate = tasa_o_cuota * 100  # Convert rate to percentage
+        # Skip taxes with 0% rate or 0 amount
+        if tax_rate == 0 or importe == 0:
+            continue
+        yield tax_name(impuesto), tax_rate, importe
+
+
+def _parser():
+    parser = getattr(_parsers, 'parser', None)
+    if parser is None:
+        parser = _parsers.parser = etree.XMLParser(remove_blank_text=True, resolve_entities=False, no_network=True)
+    return parser
+
+
+def parse_cfdi(source, tipo=None):
+    """
+    Extract the fields the integrations use from a CFDI in a single parse.
+
+    source is a path or a binary file object. Each element is looked up once
+    through the precompiled XPath expressions above. When tipo is given and
+    TipoDeComprobante differs, None is returned before any child is visited.
+    CFDIs are a few KB, so a full etree.parse is used rather than iterparse:
+    on the Inputs/ samples iterparse with clear() was 1.3-1.6x slower.
+
+    Returns a dict:
+        tipo, fecha, folio, total, uuid, emisor_nombre, emisor_rfc,
+        receptor_nombre, uso_cfdi,
+        conceptos: [{descripcion, cantidad, valor_unitario,
+                     traslados: [(impuesto, tasa_o_cuota, importe), ...]}, ...]
+    """
+    try:
+        root = etree.parse(source, _parser()).getroot()
+        if root.tag != _COMPROBANTE:
+            raise CfdiParseError('Not a CFDI 4.0 Comprobante')
+
+        attrib = root.attrib
+        document_tipo = attrib.get('TipoDeComprobante')
+        if tipo is not None and document_tipo != tipo:
+            return None
+
+        emisor = _EMISOR(root)[0].attrib
+        receptor = _RECEPTOR(root)
+        receptor = receptor[0].attrib if receptor else {}
+        timbre = _TIMBRE(root)
+
+        conceptos = []
+        for concepto in _CONCEPTOS(root):
+            concepto_attrib = concepto.attrib
+            conceptos.append({
+                'descripcion': concepto_attrib['Descripcion'],
+                'cantidad': float(concepto_attrib['Cantidad']),
+                'valor_unitario': float(concepto_attrib['ValorUnitario']),
+                # Exento traslados carry no TasaOCuota/Importe and add nothing to the bill
+                'traslados': [
+                    (traslado.get('Impuesto'), float(traslado.get('TasaOCuota')), float(traslado.get('Importe')))
+                    for traslado in _TRASLADOS(concepto)
+                    if traslado.get('TasaOCuota') is not None
+                ],
+            })
+
+        return {
+            'tipo': document_tipo,
+            'fecha': attrib['Fecha'],
+            'folio': attrib.get('Folio', 'N/A'),
+            'total': float(attrib['Total']),
+            'uuid': timbre[0].get('UUID', '') if timbre else '',
+            'emisor_nombre': emisor['Nombre'],
+            'emisor_rfc': emisor['Rfc'],
+            'receptor_nombre': receptor.get('Nombre', ''),
+            'uso_cfdi': receptor.get('UsoCFDI', ''),
+            'conceptos': conceptos,
+        }
+    except etree.XMLSyntaxError as e:
+        raise CfdiParseError(f'Invalid XML: {e}') from e
+    except (KeyError, IndexError) as e:
+        raise CfdiParseError(f'Missing element or attribute {e}') from e
+    except (TypeError, ValueError) as e:
+        raise CfdiParseError(f'Invalid value: {e}') from e
+
+
+def parse_cfdi_file(source, tipo=None):
+    """parse_cfdi that logs and returns None instead of raising, as the integrations expect."""
+    name = getattr(source, 'name', source)
+    logging.info(f'Parsing XML file: {name}')
+    try:
+        document = parse_cfdi(source, tipo)
+    except CfdiParseError as e:
+        logging.error(f'Error parsing XML file {name}: {e}')
+        return None
+    if document is None:
+        logging.info(f"Skipping file {name} as TipoDeComprobante is not '{tipo}'")
+    return document
+
+
+def build_invoice(cfdi):
+    """Map a parsed CFDI to the compact Invoice stored in dataInvoice and returned by /invoices."""
+    # Accumulate tax totals per tax name and rate
+    tax_totals = {}
+    line_items = []
+
+    # Process line items (Conceptos)
+    for concepto in cfdi['conceptos']:
+        for name, tax_rate, tax_amount in concepto_taxes(concepto):
+            tax_id = f"{name} ({tax_rate}%)"
+            tax_totals[tax_id] = tax_totals.get(tax_id, 0) + tax_amount
+        line_items.append(LineItem(concepto['descripcion'], concepto['cantidad'], concepto['valor_unitario']))
+
+    return Invoice(
+        vendor_name=intern(cfdi['emisor_nombre']),
+        rfc=intern(cfdi['emisor_rfc']),
+        bill_number=cfdi['folio'],
+        date=intern(cfdi['fecha'][:10]),
+        uuid=cfdi['uuid'],
+        uso_cfdi=intern(cfdi['uso_cfdi']),
+        line_items=line_items,
+        taxes=[Tax(intern(tax_id), amount) for tax_id, amount in tax_totals.items()],
+    )
@@ -0,0 +1,103 @@
+import io
+import os
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+from cfdi_parser import CfdiParseError, parse_cfdi, build_invoice
+
+# Worker processes used to parse large solicitudes
+CFDI_PARSE_PROCESSES = int(os.getenv('CFDI_PARSE_PROCESSES', str(os.cpu_count() or 1)))
+# XMLs sent to a worker per task
+CFDI_PARSE_BATCH_SIZE = int(os.getenv('CFDI_PARSE_BATCH_SIZE', '200'))
+# Solicitudes with fewer XMLs than this are parsed in-process; pickling them costs more than it saves
+CFDI_PARSE_POOL_THRESHOLD = int(os.getenv('CFDI_PARSE_POOL_THRESHOLD', '400'))
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # spawn: forking a threaded WSGI/scheduler process could copy held locks into the children.
+            # Spawned workers re-import the parent's __main__ as __mp_main__, so main.py keeps its
+            # scheduler and index setup in start_background_services() instead of at import time.
+            _pool = ProcessPoolExecutor(
+                max_workers=CFDI_PARSE_PROCESSES,
+                mp_context=multiprocessing.get_context('spawn'),
+            )
+        return _pool
+
+
+def parse_invoice_batch(batch):
+    """
+    Parse a list of (name, xml bytes) into Invoice objects. Runs in the worker
+    processes, so problems are returned as (name, message) instead of logged.
+    """
+    invoices = []
+    errors = []
+    for name, data in batch:
+        try:
+            cfdi = parse_cfdi(io.BytesIO(data), tipo='I')
+            if cfdi is not None:
+                invoices.append(build_invoice(cfdi))
+        except CfdiParseError as e:
+            errors.append((name, str(e)))
+    return invoices, errors
+
+
+def _collect(result):
+    invoices, errors = result
+    for name, message in errors:
+        logging.error(f'Error parsing XML file {name}: {message}')
+    return invoices
+
+
+def parse_invoices(xml_items):
+    """
+    Parse an iterable of (name, xml bytes) and yield Invoice objects.
+
+    Items are grouped into batches of CFDI_PARSE_BATCH_SIZE. If the stream ends
+    before CFDI_PARSE_POOL_THRESHOLD documents it is parsed in this process;
+    otherwise batches are spread over the process pool, with at most two
+    batches per worker in flight so memory stays bounded while the downloads
+    keep producing XMLs.
+    """
+    buffered = []
+    xml_items = iter(xml_items)
+    for item in xml_items:
+        buffered.append(item)
+        if len(buffered) >= CFDI_PARSE_POOL_THRESHOLD:
+            break
+    else:
+        yield from _collect(parse_invoice_batch(buffered))
+        return
+
+    pool = _get_pool()
+    max_in_flight = 2 * CFDI_PARSE_PROCESSES
+    in_flight = set()
+
+    def batches():
+        for start in range(0, len(buffered), CFDI_PARSE_BATCH_SIZE):
+            yield buffered[start:start + CFDI_PARSE_BATCH_SIZE]
+        batch = []
+        for item in xml_items:
+            batch.append(item)
+            if len(batch) >= CFDI_PARSE_BATCH_SIZE:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    for batch in batches():
+        if len(in_flight) >= max_in_flight:
+            done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield from _collect(future.result())
+        in_flight.add(pool.submit(parse_invoice_batch, batch))
+
+    for future in in_flight:
+        yield from _collect(future.result())
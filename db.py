@@ -28,3 +28,4 @@ client = MongoClient(connection_string, serverSelectionTimeoutMS=5000)
 db = client[MONGO_DB]
 users_collection = db['clients']
 invoices_collection = db['invoices'] 
+requests_collection = db['requests']
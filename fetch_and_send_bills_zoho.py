@@ -1,20 +1,26 @@
-import base64
-import datetime
 import os
-import time
-import zipfile
-import xml.etree.ElementTree as ET
+import datetime
 import json
-import requests
+import http_client
 import logging
-from datetime import datetime
-from db import db, invoices_collection
+from datetime import datetime, date, timedelta
+from db import db, requests_collection
 import uuid
 import boto3
-from aws_utils import fetch_from_s3
+from fiel_cache import load_fiel
+from cfdi_parser import parse_cfdi_file, concepto_taxes, build_invoice
+from cfdi_pool import parse_invoices
+from invoice_store import InvoiceStoreError, insert_invoice_batches
+from zoho_rate_limit import call_zoho
+from zoho_async import ZOHO_ASYNC, push_bills_async
+from zoho_catalog import forget_rejected, get_or_create_tax, item_key, lookup_item, lookup_vendor, remember_item, remember_vendor
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from sat_token_cache import get_sat_token
+from sat_download import iter_solicitud_xml
+from sat_poller import SolicitudError, watch_solicitud, wait_for_solicitud
 
 
-from cfdiclient import Autenticacion, DescargaMasiva, Fiel, SolicitaDescarga, VerificaSolicitudDescarga
+from cfdiclient import SolicitaDescarga
 
 # Configure logging
 logging.basicConfig(
@@ -25,34 +31,27 @@ logging.basicConfig(
 
 zoho_url = 'https://www.zohoapis.com/'
 
+# Bills posted to Zoho at the same time across all orgs; each org is still paced by its token bucket
+ZOHO_SUBMIT_WORKERS = int(os.getenv('ZOHO_SUBMIT_WORKERS', '8'))
+_submit_executor = ThreadPoolExecutor(max_workers=ZOHO_SUBMIT_WORKERS, thread_name_prefix='zoho-submit')
+
 def fetch_and_send_bills_zoho(client_data):
     logging.info('Executing fetch_and_send_bills')
     try:
         RFC = client_data['rfc']
-        FIEL_CER = client_data['cer_path']
-        FIEL_KEY = client_data['key_path']
-        FIEL_PAS = client_data['password']
         org_id = client_data.get('org_id')
         auth_token = client_data.get('authtoken')
 
         if org_id is None or auth_token is None:
             logging.error('Error: org_id or auth_token is missing from client data')
-            return
-
-        FECHA_INICIAL = datetime.date.today() - datetime.timedelta(days=4)
-        FECHA_FINAL = datetime.date.today()
-        PATH = 'Inputs/' + RFC + '/'
-
-        os.makedirs(PATH, exist_ok=True)
-
-        cer_der = open(FIEL_CER, 'rb').read()
-        key_der = open(FIEL_KEY, 'rb').read()
+            return False
 
-        fiel = Fiel(cer_der, key_der, FIEL_PAS)
+        FECHA_INICIAL = date.today() - timedelta(days=4)
+        FECHA_FINAL = date.today()
 
-        auth = Autenticacion(fiel)
+        fiel = load_fiel(client_data)
 
-        token = auth.obtener_token()
+        token = get_sat_token(fiel, RFC)
         logging.info(f'Token obtained: {token}')
 
         descarga = SolicitaDescarga(fiel)
@@ -64,114 +63,67 @@ def fetch_and_send_bills_zoho(client_data):
         logging.info(f'Solicitud: {solicitud}')
 
         solicitud_id = solicitud['id_solicitud']
-        solicitud_path = os.path.join(PATH, solicitud_id)
 
-        if not os.path.exists(solicitud_path):
-            os.makedirs(solicitud_path)
-            logging.info(f'Created directory: {solicitud_path}')
-
-        while True:
-            token = auth.obtener_token()
-            logging.info(f'Token obtained: {token}')
-
-            verificacion = VerificaSolicitudDescarga(fiel)
-            verificacion = verificacion.verificar_descarga(
-                token, RFC, solicitud['id_solicitud'])
-
-            logging.info(f'Verificacion: {verificacion}')
-
-            estado_solicitud = int(verificacion['estado_solicitud'])
-
-            if estado_solicitud <= 2:
-                time.sleep(60)
-                continue
-            elif estado_solicitud >= 4:
-                logging.error(f'Error with estado_solicitud: {estado_solicitud}')
-                break
-            else:
-                for paquete in verificacion['paquetes']:
-                    descarga = DescargaMasiva(fiel)
-                    descarga = descarga.descargar_paquete(token, RFC, paquete)
-                    logging.info(f'Descarga package: {paquete}')
-                    zip_path = os.path.join(solicitud_path, f'{paquete}.zip')
-                    with open(zip_path, 'wb') as fp:
-                        fp.write(base64.b64decode(descarga['paquete_b64']))
-                    logging.info(f'Saved ZIP file: {zip_path}')
-                break
-
-        extract_zip_files(solicitud_path)
-
-        # Fetch Zoho taxes once at the beginning
-        zoho_taxes = fetch_zoho_taxes(org_id, auth_token)
-
-        for file in os.listdir(solicitud_path):
-            if file.endswith('.xml'):
-                invoice_data = parse_xml_and_get_data(os.path.join(solicitud_path, file), org_id, auth_token, zoho_url, zoho_taxes)
-                if invoice_data:  # Ensure invoice_data is not None
-                    send_to_zoho(invoice_data, org_id, auth_token)
+        # Wait on the shared poller instead of a private sleep loop
+        try:
+            verificacion = wait_for_solicitud(fiel, RFC, solicitud_id)
+        except SolicitudError as e:
+            logging.error(f'Error with solicitud {solicitud_id}: {e}')
+            return False
+
+        # Packages are read in memory and each XML goes straight to the parser
+        cfdis = []
+        for _, xml_file in iter_solicitud_xml(fiel, RFC, verificacion.get('paquetes', [])):
+            cfdi = parse_cfdi_file(xml_file, tipo='I')
+            if cfdi is not None:
+                cfdis.append(cfdi)
+
+        if ZOHO_ASYNC:
+            # Vendors, items and bill posts overlap on one event loop, bounded by the client's semaphore
+            _, failed = push_bills_async(
+                cfdis, org_id, auth_token,
+                lambda cfdi, item_ids, vendor_ids: build_zoho_bill(cfdi, org_id, auth_token, zoho_url, item_ids, vendor_ids)
+            )
+            return failed == 0
+
+        # All distinct vendors and items of the solicitud are resolved up front, mostly from the per-org caches
+        vendor_ids = resolve_vendors(cfdis, org_id, auth_token, zoho_url)
+        item_ids = resolve_items(cfdis, org_id, auth_token, zoho_url)
+
+        bills = []
+        for cfdi in cfdis:
+            invoice_data = build_zoho_bill(cfdi, org_id, auth_token, zoho_url, item_ids, vendor_ids)
+            if invoice_data:  # Ensure invoice_data is not None
+                bills.append(invoice_data)
+
+        # Bills are posted concurrently, paced by the org's rate limit
+        _, failed = submit_bills(bills, org_id, auth_token)
+        return failed == 0
 
     except Exception as e:
         logging.error(f'Error in fetch_and_send_bills: {e}')
+        return False
 
-def extract_zip_files(directory):
-    for item in os.listdir(directory):
-        if item.endswith('.zip'):
-            file_name = os.path.join(directory, item)
-            logging.info(f'Extracting {file_name}...')
-            try:
-                with zipfile.ZipFile(file_name, 'r') as zip_ref:
-                    zip_ref.extractall(directory)
-                logging.info(f'Successfully extracted {file_name}')
-                os.remove(file_name)  # Remove zip file after extraction
-                logging.info(f'Removed ZIP file: {file_name}')
-            except zipfile.BadZipFile:
-                logging.error(f'Error: {file_name} is not a valid zip file')
-            except Exception as e:
-                logging.error(f'Error extracting {file_name}: {e}')
-
-def parse_xml_and_get_data(file_path, org_id, auth_token, zoho_url, zoho_taxes):
-    logging.info(f'Parsing XML file: {file_path}')
+def build_zoho_bill(cfdi, org_id, auth_token, zoho_url, item_ids=None, vendor_ids=None):
+    """Map a parsed CFDI to a Zoho bill; the maps from resolve_items/resolve_vendors save the per-bill lookups."""
     try:
-        tree = ET.parse(file_path)
-        root = tree.getroot()
-
-        # Define the namespaces
-        ns = {
-            'cfdi': 'http://www.sat.gob.mx/cfd/4',
-            'tfd': 'http://www.sat.gob.mx/TimbreFiscalDigital'
-        }
-
-        # Check if TipoDeComprobante is 'I' (for Ingreso)
-        if root.attrib.get('TipoDeComprobante') != 'I':
-            logging.info(f"Skipping file {file_path} as TipoDeComprobante is not 'I'")
-            return None
-
-        vendor_name = root.find('cfdi:Emisor', ns).attrib['Nombre']
-        vendor_id = search_or_create_vendor(vendor_name, org_id, auth_token, zoho_url)
-
-        # Extract and format the invoice date
-        raw_date = root.attrib['Fecha']
-        formatted_date = datetime.datetime.strptime(raw_date, "%Y-%m-%dT%H:%M:%S").strftime("%Y-%m-%d")
-
-        # Extract UsoCFDI from cfdi:Receptor
-        uso_cfdi = root.find('cfdi:Emisor', ns).attrib.get('UsoCFDI', '')
-
-        # Extract UUID from tfd:TimbreFiscalDigital
-        uuid = root.find('.//tfd:TimbreFiscalDigital', ns).attrib.get('UUID', '')
+        vendor_id = (vendor_ids or {}).get(cfdi['emisor_rfc'])
+        if vendor_id is None:
+            vendor_id = search_or_create_vendor(cfdi['emisor_nombre'], org_id, auth_token, zoho_url, rfc=cfdi['emisor_rfc'])
 
         invoice_data = {
             'rfc': vendor_id,
-            'bill_number': root.attrib.get('Folio', 'N/A'),
-            'date': formatted_date,
+            'bill_number': cfdi['folio'],
+            'date': cfdi['fecha'][:10],
             'line_items': [],
             "custom_fields": [
                 {
                     "label": "IdDocumento",
-                    "value": uuid
+                    "value": cfdi['uuid']
                 },
                 {
                     "label": "UsoCFDI",
-                    "value": uso_cfdi
+                    "value": cfdi['uso_cfdi']
                 }
             ],
             "taxes": []
@@ -180,54 +132,31 @@ def parse_xml_and_get_data(file_path, org_id, auth_token, zoho_url, zoho_taxes):
         # Dictionary to accumulate tax totals
         tax_totals = {}
 
-        conceptos = root.find('cfdi:Conceptos', ns)
-        for concepto in conceptos.findall('cfdi:Concepto', ns):
-            item_name = concepto.attrib['Descripcion']
-            item_id = search_or_create_item(item_name, org_id, auth_token, zoho_url)
+        for concepto in cfdi['conceptos']:
+            item_id = (item_ids or {}).get(item_key(concepto['descripcion']))
+            if item_id is None:
+                item_id = search_or_create_item(concepto['descripcion'], org_id, auth_token, zoho_url)
             
             # Extract tax information for this line item
             line_tax_id = None
-            impuestos = concepto.find('cfdi:Impuestos', ns)
-            if impuestos is not None:
-                traslados = impuestos.find('cfdi:Traslados', ns)
-                if traslados is not None:
-                    for traslado in traslados.findall('cfdi:Traslado', ns):
-                        tax_rate = float(traslado.attrib['TasaOCuota']) * 100  # Convert rate to percentage
-                        tax_amount = float(traslado.attrib['Importe'])  # Extract tax amount
-
-                        # Skip taxes with 0% rate or 0 amount
-                        if tax_rate == 0 or tax_amount == 0:
-                            continue
-
-                        impuesto = traslado.attrib['Impuesto']
-                        
-                        # Determine the tax name based on 'Impuesto'
-                        if impuesto == '001':
-                            tax_name = "ISR"
-                        elif impuesto == '002':
-                            tax_name = "IVA"
-                        elif impuesto == '003':
-                            tax_name = "IEPS"
-                        else:
-                            tax_name = "Unknown Tax"
-                        
-                        # Find or create the corresponding tax_id
-                        line_tax_id = find_or_create_tax(zoho_taxes, tax_name, tax_rate, org_id, auth_token, zoho_url)
-
-                        # Accumulate tax amounts in the dictionary
-                        if line_tax_id in tax_totals:
-                            tax_totals[line_tax_id]['tax_amount'] += tax_amount
-                        else:
-                            tax_totals[line_tax_id] = {
-                                "tax_id": line_tax_id,
-                                "tax_name": f"{tax_name} ({tax_rate}%)",
-                                "tax_amount": tax_amount
-                            }
+            for tax_name, tax_rate, tax_amount in concepto_taxes(concepto):
+                # Find or create the corresponding tax_id
+                line_tax_id = find_or_create_tax(tax_name, tax_rate, org_id, auth_token, zoho_url)
+
+                # Accumulate tax amounts in the dictionary
+                if line_tax_id in tax_totals:
+                    tax_totals[line_tax_id]['tax_amount'] += tax_amount
+                else:
+                    tax_totals[line_tax_id] = {
+                        "tax_id": line_tax_id,
+                        "tax_name": f"{tax_name} ({tax_rate}%)",
+                        "tax_amount": tax_amount
+                    }
 
             line_item = {
                 'item_id': item_id,
-                'quantity': float(concepto.attrib['Cantidad']),
-                'rate': float(concepto.attrib['ValorUnitario']),
+                'quantity': concepto['cantidad'],
+                'rate': concepto['valor_unitario'],
                 'tax_id': line_tax_id  # Assign the tax_id to the line item
             }
             invoice_data['line_items'].append(line_item)
@@ -236,12 +165,11 @@ def parse_xml_and_get_data(file_path, org_id, auth_token, zoho_url, zoho_taxes):
         invoice_data['taxes'] = list(tax_totals.values())
 
         return invoice_data
-    except ET.ParseError as e:
-        logging.error(f'Error parsing XML file {file_path}: {e}')
     except Exception as e:
-        logging.error(f'Error processing file {file_path}: {e}')
+        logging.error(f"Error processing CFDI {cfdi.get('uuid')}: {e}")
 
 def send_to_zoho(invoice_data, org_id, auth_token):
+    """Post one bill under the org's rate limit, backing off on 429. Returns True when Zoho created it."""
     headers = {
         'Content-Type': 'application/json',
         'Authorization': f'Zoho-oauthtoken {auth_token}',
@@ -249,15 +177,37 @@ def send_to_zoho(invoice_data, org_id, auth_token):
     }
     try:
         logging.info(f"Sending invoice {invoice_data} to Zoho...")
-        response = requests.post(f"{zoho_url}books/v3/bills", data=json.dumps(invoice_data), headers=headers)
+        body = json.dumps(invoice_data)
+        response = call_zoho(org_id, lambda: http_client.post(f"{zoho_url}books/v3/bills", data=body, headers=headers))
         if response.status_code == 201:
             logging.info(f"Invoice {invoice_data['bill_number']} sent successfully to Zoho.")
+            return True
         else:
             logging.error(f"Failed to send invoice {invoice_data['bill_number']} to Zoho. Status Code: {response.status_code}, Response: {response.text}")
+            if response.status_code == 400:
+                # A cached vendor, item or tax deleted in Zoho must not be sent again
+                forget_rejected(org_id, auth_token, invoice_data, response.text)
     except Exception as e:
         logging.error(f"Error sending invoice to Zoho: {e}")
+    return False
+
+def submit_bills(bills, org_id, auth_token):
+    """
+    Post the bills of a solicitud on the shared submission pool. Each post waits
+    for the org's token bucket, so the pool runs at Zoho's per-org rate instead
+    of one bill at a time. Returns (sent, failed).
+    """
+    futures = [_submit_executor.submit(send_to_zoho, bill, org_id, auth_token) for bill in bills]
+    sent = sum(1 for future in as_completed(futures) if future.result())
+    logging.info(f"Sent {sent} of {len(bills)} bills to Zoho org {org_id}")
+    return sent, len(bills) - sent
+
+def search_or_create_vendor(vendor_name, org_id, auth_token, zoho_url, rfc=None):
+    # Repeat vendors are answered from the per-org cache without calling Zoho
+    contact_id = lookup_vendor(org_id, auth_token, vendor_name, rfc)
+    if contact_id:
+        return contact_id
 
-def search_or_create_vendor(vendor_name, org_id, auth_token, zoho_url):
     headers = {
         'Content-Type': 'application/json',
         'Authorization': f'Zoho-oauthtoken {auth_token}',
@@ -266,7 +216,7 @@ def search_or_create_vendor(vendor_name, org_id, auth_token, zoho_url):
 
     try:
         # Search for the vendor by name
-        response = requests.get(f"{zoho_url}books/v3/contacts?organization_id={org_id}&contact_name_contains={vendor_name}", headers=headers)
+        response = call_zoho(org_id, lambda: http_client.get(f"{zoho_url}books/v3/contacts?organization_id={org_id}&contact_name_contains={vendor_name}", headers=headers))
         if response.status_code == 200:
             logging.info(f"Response vendors: {response.json()}")
             vendors = response.json().get('contacts', [])
@@ -274,6 +224,7 @@ def search_or_create_vendor(vendor_name, org_id, auth_token, zoho_url):
             # Check if any of the contacts is of type 'vendor'
             for contact in vendors:
                 if contact['contact_type'] == 'vendor':
+                    remember_vendor(org_id, auth_token, vendor_name, rfc, contact['contact_id'])
                     return contact['contact_id']
             
             # If no vendor is found, create a new vendor contact
@@ -282,9 +233,10 @@ def search_or_create_vendor(vendor_name, org_id, auth_token, zoho_url):
                 "contact_name": vendor_name + " (Vendor)",
                 "contact_type": "vendor"
             }
-            create_response = requests.post(f"{zoho_url}books/v3/contacts", headers=headers, json=vendor_data)
+            create_response = call_zoho(org_id, lambda: http_client.post(f"{zoho_url}books/v3/contacts", headers=headers, json=vendor_data))
             if create_response.status_code == 201:
                 new_vendor = create_response.json()
+                remember_vendor(org_id, auth_token, vendor_name, rfc, new_vendor['contact']['contact_id'])
                 return new_vendor['contact']['contact_id']
             else:
                 logging.error(f"Failed to create vendor {vendor_name} in Zoho. Status Code: {create_response.status_code}, Response: {create_response.text}")
@@ -306,175 +258,218 @@ def search_or_create_item(item_name, org_id, auth_token, zoho_url):
 
     try:
         # Ensure the item name is less than 100 characters
-        if len(item_name) > 99:
-            item_name = item_name[:99]
-
-        # Search for the item by name
-        response = requests.get(f"{zoho_url}books/v3/items?organization_id={org_id}&name_startswith={item_name}", headers=headers)
-        if response.status_code == 200:
+        item_name = item_key(item_name)
+
+        # Known items are answered from the per-org cache; only a sales-only item still needs the PUT below
+        item = lookup_item(org_id, auth_token, item_name)
+        if item is None:
+            # Search for the item by name
+            response = call_zoho(org_id, lambda: http_client.get(f"{zoho_url}books/v3/items?organization_id={org_id}&name_startswith={item_name}", headers=headers))
+            if response.status_code != 200:
+                logging.error(f"Failed to search item {item_name} in Zoho. Status Code: {response.status_code}, Response: {response.text}")
+                return None
             items = response.json().get('items', [])
             if items:
-                # Item found, check its type
-                item = items[0]
-                item_id = item['item_id']
-                if item['item_type'] == 'sales':
-                    # Update item to be sales_and_purchases
-                    update_data = {
-                        "item_type": "sales_and_purchases"
-                    }
-                    update_response = requests.put(f"{zoho_url}books/v3/items/{item_id}?organization_id={org_id}", headers=headers, json=update_data)
-                    if update_response.status_code == 200:
-                        logging.info(f"Item {item_name} updated to sales_and_purchases")
-                    else:
-                        logging.error(f"Failed to update item {item_name} to sales_and_purchases. Status Code: {update_response.status_code}, Response: {update_response.text}")
-                return item_id
-            else:
-                # Item not found, create a new one
-                item_data = {
-                    "name": item_name,
-                    "item_type": "sales_and_purchases",
-                    "rate": 0  # Placeholder rate, can be adjusted later
+                item = {'item_id': items[0]['item_id'], 'item_type': items[0]['item_type']}
+                remember_item(org_id, auth_token, item_name, item['item_id'], item['item_type'])
+
+        if item:
+            # Item found, check its type
+            item_id = item['item_id']
+            if item['item_type'] == 'sales':
+                # Update item to be sales_and_purchases
+                update_data = {
+                    "item_type": "sales_and_purchases"
                 }
-                create_response = requests.post(f"{zoho_url}books/v3/items", headers=headers, json=item_data)
-                if create_response.status_code == 201:
-                    new_item = create_response.json()
-                    logging.info(f"Item created: {new_item}")
-                    return new_item['item']['item_id']
+                update_response = call_zoho(org_id, lambda: http_client.put(f"{zoho_url}books/v3/items/{item_id}?organization_id={org_id}", headers=headers, json=update_data))
+                if update_response.status_code == 200:
+                    logging.info(f"Item {item_name} updated to sales_and_purchases")
+                    remember_item(org_id, auth_token, item_name, item_id, 'sales_and_purchases')
                 else:
-                    logging.error(f"Failed to create item {item_name} in Zoho. Status Code: {create_response.status_code}, Response: {create_response.text}")
-                    return None
+                    logging.error(f"Failed to update item {item_name} to sales_and_purchases. Status Code: {update_response.status_code}, Response: {update_response.text}")
+            return item_id
         else:
-            logging.error(f"Failed to search item {item_name} in Zoho. Status Code: {response.status_code}, Response: {response.text}")
-            return None
+            # Item not found, create a new one
+            item_data = {
+                "name": item_name,
+                "item_type": "sales_and_purchases",
+                "rate": 0  # Placeholder rate, can be adjusted later
+            }
+            create_response = call_zoho(org_id, lambda: http_client.post(f"{zoho_url}books/v3/items", headers=headers, json=item_data))
+            if create_response.status_code == 201:
+                new_item = create_response.json()
+                logging.info(f"Item created: {new_item}")
+                remember_item(org_id, auth_token, item_name, new_item['item']['item_id'], 'sales_and_purchases')
+                return new_item['item']['item_id']
+            else:
+                logging.error(f"Failed to create item {item_name} in Zoho. Status Code: {create_response.status_code}, Response: {create_response.text}")
+                return None
     except Exception as e:
         logging.error(f"Error searching or creating item in Zoho: {e}")
         return None
 
-def fetch_zoho_taxes(org_id, auth_token):
-    headers = {
-        'Authorization': f'Zoho-oauthtoken {auth_token}',
-        'Content-Type': 'application/json'
-    }
-    response = requests.get(f'{zoho_url}books/v3/settings/taxes?organization_id={org_id}', headers=headers)
-    if response.status_code == 200:
-        logging.info("Successfully fetched Zoho taxes")
-        return response.json().get('taxes', [])
-    else:
-        logging.error(f"Failed to fetch Zoho taxes. Status Code: {response.status_code}, Response: {response.text}")
-        return []
-
-def find_or_create_tax(zoho_taxes, tax_name, tax_percentage, org_id, auth_token, zoho_url):
-    # Find existing tax
-    for tax in zoho_taxes:
-        if tax_name in tax['tax_name'] and abs(tax['tax_percentage'] - tax_percentage) < 0.01:
-            return tax['tax_id']
-    
-    # Tax not found, attempt to create it
-    logging.info(f"Creating new tax: {tax_name} ({tax_percentage}%)")
-    tax_data = {
-        "tax_name": tax_name,
-        "tax_percentage": tax_percentage,
-        "tax_type": "tax",
-        "tax_factor": "rate"
+def resolve_vendors(cfdis, org_id, auth_token, zoho_url):
+    """Resolve the Zoho contact_id of every distinct emisor of a solicitud. Returns {rfc: contact_id}."""
+    emisores = {cfdi['emisor_rfc']: cfdi['emisor_nombre'] for cfdi in cfdis}
+    return {
+        rfc: search_or_create_vendor(vendor_name, org_id, auth_token, zoho_url, rfc=rfc)
+        for rfc, vendor_name in emisores.items()
     }
-    headers = {
-        'Authorization': f'Zoho-oauthtoken {auth_token}',
-        'Content-Type': 'application/json'
-    }
-    response = requests.post(f'{zoho_url}books/v3/settings/taxes?organization_id={org_id}', headers=headers, json=tax_data)
-    
-    if response.status_code == 201:
-        new_tax = response.json().get('tax')
-        zoho_taxes.append(new_tax)  # Update the local cache of taxes
-        logging.info(f"Created new tax with ID: {new_tax['tax_id']}")
-        return new_tax['tax_id']
-    else:
-        logging.error(f"Failed to create tax {tax_name} ({tax_percentage}%) with tax_factor. Status Code: {response.status_code}, Response: {response.text}")
-        return None
 
+def resolve_items(cfdis, org_id, auth_token, zoho_url):
+    """
+    Resolve the Zoho item_id of every distinct concepto description of a solicitud
+    before any bill is built, so each name costs at most one lookup per run.
+    Returns {truncated name: item_id}.
+    """
+    names = {item_key(concepto['descripcion']) for cfdi in cfdis for concepto in cfdi['conceptos']}
+    logging.info(f"Resolving {len(names)} distinct Zoho items for {len(cfdis)} invoices")
+    return {name: search_or_create_item(name, org_id, auth_token, zoho_url) for name in names}
+
+def find_or_create_tax(tax_name, tax_percentage, org_id, auth_token, zoho_url):
+    # Existing taxes are looked up by (tax kind, rounded percentage) in the per-org registry
+    def create_tax():
+        logging.info(f"Creating new tax: {tax_name} ({tax_percentage}%)")
+        tax_data = {
+            "tax_name": tax_name,
+            "tax_percentage": tax_percentage,
+            "tax_type": "tax",
+            "tax_factor": "rate"
+        }
+        headers = {
+            'Authorization': f'Zoho-oauthtoken {auth_token}',
+            'Content-Type': 'application/json'
+        }
+        response = call_zoho(org_id, lambda: http_client.post(f'{zoho_url}books/v3/settings/taxes?organization_id={org_id}', headers=headers, json=tax_data))
 
+        if response.status_code == 201:
+            new_tax = response.json().get('tax')
+            logging.info(f"Created new tax with ID: {new_tax['tax_id']}")
+            return new_tax['tax_id']
+        else:
+            logging.error(f"Failed to create tax {tax_name} ({tax_percentage}%) with tax_factor. Status Code: {response.status_code}, Response: {response.text}")
+            return None
+
+    return get_or_create_tax(org_id, auth_token, tax_name, tax_percentage, create_tax)
+
+
+
+def create_invoice_request(client_data, start_date, end_date):
+    """Insert the 'Pendiente' entry for a new batch in the requests collection and return its requestId."""
+    tenant = client_data.get('tenant', 1)  # Default tenant if not provided
+
+    # Generate a unique requestId for the entire batch
+    batch_request_id = str(uuid.uuid4())
+    logging.info(f"Batch requestId: {batch_request_id}")
+
+    # Status, counts and timings of the request live here; invoice rows only carry the requestId
+    request_record = {
+        'requestId': batch_request_id,
+        'created_at': datetime.utcnow(),
+        'request_status':'Pendiente', 
+        'progress': 'en_cola',
+        'start_date': start_date,
+        'end_date': end_date,
+        'tenant': tenant,
+        'invoice_count': 0,
+    }
+    requests_collection.insert_one(request_record)
+    logging.info(f"Request created with requestId: {batch_request_id}")
+    return batch_request_id
+
+def update_invoice_request(request_id, **fields):
+    """
+    Record progress on the requests collection entry of a request. Setting a final
+    request_status ('Ejecutado' or 'Error') also stamps completed_at and duration_seconds.
+    """
+    now = datetime.utcnow()
+    fields['updated_at'] = now
+    # Pipeline update so the duration is computed from the stored created_at; values are literals
+    update = {name: {'$literal': value} for name, value in fields.items()}
+    if fields.get('request_status') in ('Ejecutado', 'Error'):
+        update['completed_at'] = {'$literal': now}
+        update['duration_seconds'] = {'$divide': [{'$subtract': [now, '$created_at']}, 1000]}
+    try:
+        requests_collection.update_one({'requestId': request_id}, [{'$set': update}])
+    except Exception as e:
+        logging.error(f"Error updating request {request_id}: {e}")
 
-def fetch_and_return_invoices(client_data, start_date, end_date):
+def fetch_and_return_invoices(client_data, start_date, end_date, request_id=None):
     logging.info('Executing fetch_and_return_invoices')
+    return fetch_invoices_async(client_data, start_date, end_date, request_id).result()
+
+def fetch_invoices_async(client_data, start_date, end_date, request_id=None):
+    """
+    File the SAT solicitud for the request and hand it to the shared poller.
+
+    Returns a Future that resolves to the same result dict fetch_and_return_invoices
+    returns; the caller's thread is free while SAT prepares the packages.
+    """
+    result_future = Future()
+
+    def finish(result):
+        if not result.get('success'):
+            update_invoice_request(request_id, request_status='Error', progress='error', error_message=result.get('message'))
+        result['requestId'] = request_id
+        result_future.set_result(result)
+
+    if request_id is None:
+        try:
+            request_id = create_invoice_request(client_data, start_date, end_date)
+        except Exception as e:
+            error_message = f"Error inserting request into MongoDB: {e}"
+            logging.error(error_message)
+            result_future.set_result({"success": False, "message": error_message})
+            return result_future
+
+    context = _request_solicitud(client_data, start_date, end_date, request_id)
+    if not context.get('success'):
+        finish(context)
+        return result_future
+
+    def on_ready(verificacion):
+        return _download_and_store_invoices(context, verificacion, start_date, end_date, request_id)
+
+    def on_progress(estado_solicitud):
+        update_invoice_request(request_id, estado_solicitud=estado_solicitud)
+
+    def on_done(poll_future):
+        try:
+            finish(poll_future.result())
+        except Exception as e:
+            error_message = str(e)
+            logging.error(f"Error waiting for solicitud {context['solicitud_id']}: {error_message}")
+            finish({"success": False, "message": error_message})
+
+    watch_solicitud(context['fiel'], context['rfc'], context['solicitud_id'], on_ready, on_progress).add_done_callback(on_done)
+    return result_future
+
+def _request_solicitud(client_data, start_date, end_date, batch_request_id):
+    """Load the e.firma, file the SAT solicitud and return the context needed to finish it."""
     # Extract client details
     RFC = client_data.get('rfc', 'ASB191218I51')  # Default RFC if not provided
     tenant = client_data.get('tenant', 1)  # Default tenant if not provided
-    URL_FIEL_CER = client_data.get('cerUrl')  
-    URL_FIEL_KEY = client_data.get('keyUrl')
-    FIEL_CER = client_data['cer_path']
-    FIEL_KEY = client_data['key_path']
-    FIEL_PAS = client_data['password']
-    
-    # Define the input path
-    PATH = os.path.join('Inputs', RFC)
-    os.makedirs(PATH, exist_ok=True)
-    logging.info(f"Input directory set to: {PATH}")
     
-     # Read certificate and key files from URL (S3) or local file system
-    try:
-        if URL_FIEL_CER and URL_FIEL_KEY:
-            logging.info("Fetching certificate and key files from S3.")
-            cer_der = fetch_from_s3(URL_FIEL_CER)
-            key_der = fetch_from_s3(URL_FIEL_KEY)
-            FIEL_PAS = client_data['cer_pass']
-        else:
-            logging.info("Fetching certificate and key files from local file system.")
-            with open(FIEL_CER, 'rb') as cer_file:
-                cer_der = cer_file.read()
-            with open(FIEL_KEY, 'rb') as key_file:
-                key_der = key_file.read()
-
-        if not cer_der or not key_der:
-            raise Exception("Certificate or key data is missing.")
-
-        logging.info("Successfully retrieved certificate and key files.")
-    except Exception as e:
-        error_message = f"Error fetching certificate or key files: {e}"
-        logging.error(error_message)
-        return {"success": False, "message": error_message}
+    update_invoice_request(batch_request_id, progress='solicitando')
     
-    # Initialize Fiel and Autenticacion objects
+    # Read the e.firma from URL (S3) or local file system, reusing the cached decrypted copy when unchanged
     try:
-        fiel = Fiel(cer_der, key_der, FIEL_PAS)
-        auth = Autenticacion(fiel)
-        logging.info("Initialized Fiel and Autenticacion objects.")
+        fiel = load_fiel(client_data)
+        logging.info("Successfully loaded certificate and key.")
     except Exception as e:
-        error_message = f"Error initializing authentication objects: {e}"
+        error_message = f"Error loading certificate or key files: {e}"
         logging.error(error_message)
         return {"success": False, "message": error_message}
     
     # Obtain token
     try:
-        token = auth.obtener_token()
+        token = get_sat_token(fiel, RFC)
         logging.info(f'Token obtained: {token}')
     except Exception as e:
         error_message = f"Error obtaining token: {e}"
         logging.error(error_message)
         return {"success": False, "message": error_message}
-    
-    # Generate a unique requestId for the entire batch
-    batch_request_id = str(uuid.uuid4())
-    logging.info(f"Batch requestId: {batch_request_id}")
 
-    # Create a placeholder record with status "pending"
-    placeholder_record = {
-        'requestId': batch_request_id,
-        'created_at': datetime.utcnow(),
-        'request_status':'Pendiente', 
-        'start_date': start_date,
-        'end_date': end_date,
-        'tenant': tenant,
-    }
-    try:
-        invoices_collection.insert_one(placeholder_record)
-        logging.info(f"Placeholder request created with requestId: {batch_request_id}")
-    except Exception as e:
-        error_message = f"Error inserting placeholder request into MongoDB: {e}"
-        logging.error(error_message)
-        return {"success": False, "message": error_message}
-
-
-    
     # Initialize SolicitaDescarga
     try:
         descarga = SolicitaDescarga(fiel)
@@ -510,267 +505,67 @@ def fetch_and_return_invoices(client_data, start_date, end_date):
         error_message = "No 'id_solicitud' found in solicitud response."
         logging.error(error_message)
         return {"success": False, "message": error_message}
-    
-    solicitud_path = os.path.join(PATH, solicitud_id)
-    try:
-        os.makedirs(solicitud_path, exist_ok=True)
-        logging.info(f'Created directory: {solicitud_path}')
-    except Exception as e:
-        error_message = f"Error creating solicitud directory: {e}"
-        logging.error(error_message)
-        return {"success": False, "message": error_message}
-    
-    # Polling for download status
-    while True:
-        try:
-            token = auth.obtener_token()
-            logging.info(f'Token refreshed: {token}')
-        except Exception as e:
-            error_message = f"Error refreshing token: {e}"
-            logging.error(error_message)
-            return {"success": False, "message": error_message}
-        
-        try:
-            verificacion_obj = VerificaSolicitudDescarga(fiel)
-            verificacion = verificacion_obj.verificar_descarga(token, RFC, solicitud_id)
-            logging.info(f'Verificacion: {verificacion}')
-        except Exception as e:
-            error_message = f"Error during verificacion_descarga: {e}"
-            logging.error(error_message)
-            return {"success": False, "message": error_message}
-        
-        # Extract status and messages
-        cod_estatus = verificacion.get('cod_estatus')
-        estado_solicitud = int(verificacion.get('estado_solicitud', 0))
-        mensaje = verificacion.get('mensaje', 'No message provided.')
-        
-        # Check for error conditions based on 'cod_estatus'
-        if cod_estatus not in ['2000', '5000']:   # Adjust based on actual success code
-            error_message = mensaje or "Unknown error occurred during verification."
-            logging.error(f"Error in verificacion: {error_message}")
-            return {"success": False, "message": error_message}
-        
-        # Handle different states of the solicitud
-        if estado_solicitud <= 2:
-            logging.info("Solicitud in process, waiting...")
-            time.sleep(60)  # Wait for 1 minute before next check
-            continue
-        elif estado_solicitud >= 4:
-            error_message = f'Error with estado_solicitud: {estado_solicitud}'
-            logging.error(error_message)
-            return {"success": False, "message": error_message}
-        else:
-            # estado_solicitud == 3 indicates ready for download
-            paquetes = verificacion.get('paquetes', [])
-            if not paquetes:
-                error_message = "No paquetes found in verificacion response."
-                logging.error(error_message)
-                return {"success": False, "message": error_message}
-            
-            for paquete in paquetes:
-                try:
-                    descarga_obj = DescargaMasiva(fiel)
-                    descarga = descarga_obj.descargar_paquete(token, RFC, paquete)
-                    logging.info(f'Descarga package: {paquete}')
-                    
-                    zip_path = os.path.join(solicitud_path, f'{paquete}.zip')
-                    paquete_b64 = descarga.get('paquete_b64', '')
-                    if not paquete_b64:
-                        logging.error(f"No 'paquete_b64' found for paquete: {paquete}")
-                        continue  # Skip this paquete if no data
-                    
-                    with open(zip_path, 'wb') as fp:
-                        fp.write(base64.b64decode(paquete_b64))
-                    logging.info(f'Saved ZIP file: {zip_path}')
-                except Exception as e:
-                    logging.error(f"Error downloading paquete {paquete}: {e}")
-                    continue  # Continue with the next paquete
-            break  # Exit the while loop after processing
-    
-    # Extract all zip files in the folder
-    try:
-        extract_zip_files(solicitud_path)
-        logging.info(f"Extracted all ZIP files in {solicitud_path}.")
-    except Exception as e:
-        error_message = f"Error extracting ZIP files: {e}"
-        logging.error(error_message)
-        return {"success": False, "message": error_message}
-    
-    # Now, we want to return all invoices from the local folder
-    all_invoices = []
-    logging.info(f'Descarga package directory: {solicitud_path}')
-    
-    if not os.path.exists(solicitud_path):
-        error_message = f"Directory {solicitud_path} does not exist."
+    update_invoice_request(batch_request_id, progress='verificando', id_solicitud=solicitud_id)
+
+    return {
+        "success": True,
+        "fiel": fiel,
+        "rfc": RFC,
+        "tenant": tenant,
+        "solicitud_id": solicitud_id,
+    }
+
+def _download_and_store_invoices(context, verificacion, start_date, end_date, batch_request_id):
+    """Download the packages of a ready solicitud, parse them and store the invoices."""
+    fiel = context['fiel']
+    RFC = context['rfc']
+    tenant = context['tenant']
+
+    # estado_solicitud == 3 indicates ready for download
+    update_invoice_request(batch_request_id, estado_solicitud=3)
+    paquetes = verificacion.get('paquetes', [])
+    if not paquetes:
+        error_message = "No paquetes found in verificacion response."
         logging.error(error_message)
         return {"success": False, "message": error_message}
-    
-    for file in os.listdir(solicitud_path):
-        full_file_path = os.path.join(solicitud_path, file)
-        logging.info(f'Processing file: {full_file_path}')
-        
-        if file.endswith('.xml'):
-            try:
-                invoice_data = parse_xml_and_get_data_no_zoho(full_file_path)
-                if invoice_data:
-                    all_invoices.append(invoice_data)
-                    logging.info(f"Parsed invoice from {full_file_path}.")
-            except Exception as e:
-                logging.error(f"Error parsing XML file {full_file_path}: {e}")
-                continue  # Skip this file and continue with others
-    
-    if not all_invoices:
-        logging.info("No invoices found in the specified date range.")
-        return {"success": True, "invoices": []}  # No invoices is not an error
+    update_invoice_request(batch_request_id, progress='descargando', paquetes=len(paquetes))
 
-    
+    # Packages are downloaded concurrently (bounded per RFC); their XMLs are read from the
+    # in-memory ZIPs and parsed in batches, across a process pool for large solicitudes.
+    # Parsed invoices are inserted as they arrive, so memory stays bounded by one batch
+    # and /requests/<id> shows partial results while the rest is still being parsed.
+    xml_items = ((name, xml_file.read()) for name, xml_file in iter_solicitud_xml(fiel, RFC, paquetes))
 
-    # Prepare invoice records with the same requestId and status
-    invoice_records = []
-    for invoice in all_invoices:
-        invoice_record = {
-            'start_date': start_date,
-            'end_date': end_date,            
+    def make_record(invoice):
+        return {
             'requestId': batch_request_id,
             'tenant': tenant,
-            'dataInvoice': invoice,
+            'dataInvoice': invoice.to_document(),
             'status': 'not_sent',
-            'request_status':'Ejecutado',  
             'created_at': datetime.utcnow()
         }
-        invoice_records.append(invoice_record)
-
-    # Bulk insert all invoices into MongoDB
-    try:
-        invoices_collection.insert_many(invoice_records)
-        logging.info(f"Inserted {len(invoice_records)} invoices with requestId: {batch_request_id}")
-    except Exception as e:
-        error_message = f"Error inserting invoices into MongoDB: {e}"
-        logging.error(error_message)
-        return {"success": False, "message": error_message}
-    
-    try:
-            invoices_collection.delete_one({'requestId': batch_request_id, 'request_status': 'Pendiente'})
-            logging.info(f"Placeholder request with requestId: {batch_request_id} removed.")
-    except Exception as e:
-            error_message = f"Error removing placeholder request: {e}"
-            logging.error(error_message)
 
-
-    # Return the list of all invoices found
-    return {"success": True, "invoices": all_invoices}
-
-def parse_xml_and_get_data_no_zoho(file_path):
-    logging.info(f'Parsing XML file: {file_path}')
+    def on_batch(stored):
+        update_invoice_request(batch_request_id, progress='guardando', invoice_count=stored)
 
     try:
-        tree = ET.parse(file_path)
-        root = tree.getroot()
-
-        # Define the namespaces
-        ns = {
-            'cfdi': 'http://www.sat.gob.mx/cfd/4',
-            'tfd': 'http://www.sat.gob.mx/TimbreFiscalDigital'
-        }
-
-        # Check if TipoDeComprobante is 'I' (for Ingreso - Income invoice)
-        if root.attrib.get('TipoDeComprobante') != 'I':
-            logging.info(f"Skipping file {file_path} as TipoDeComprobante is not 'I'")
-            return None
-
-        # Extract vendor details
-        vendor_name = root.find('cfdi:Emisor', ns).attrib['Nombre']
-        rfc = root.find('cfdi:Emisor', ns).attrib['Rfc']
-
-        # Extract and format the invoice date
-        raw_date = root.attrib['Fecha']
-        formatted_date = datetime.strptime(raw_date, "%Y-%m-%dT%H:%M:%S").strftime("%Y-%m-%d")
-
-        # Extract UUID from tfd:TimbreFiscalDigital
-        uuid = root.find('.//tfd:TimbreFiscalDigital', ns).attrib.get('UUID', '')
-
-        # Extract UsoCFDI from cfdi:Receptor
-        uso_cfdi = root.find('cfdi:Receptor', ns).attrib.get('UsoCFDI', '')
-
-        # Prepare the invoice data structure
-        invoice_data = {
-            'vendor_name': vendor_name,
-            'rfc': rfc, 
-            'bill_number': root.attrib.get('Folio', 'N/A'),
-            'date': formatted_date,
-            'line_items': [],
-            'custom_fields': [
-                {
-                    'label': 'IdDocumento',
-                    'value': uuid
-                },
-                {
-                    'label': 'UsoCFDI',
-                    'value': uso_cfdi
-                }
-            ],
-            'taxes': []
-        }
-
-        # Dictionary to accumulate tax totals
-        tax_totals = {}
+        invoice_count = insert_invoice_batches(parse_invoices(xml_items), make_record, on_batch)
+        logging.info(f"Inserted {invoice_count} invoices with requestId: {batch_request_id}")
+    except InvoiceStoreError as e:
+        logging.error(str(e))
+        update_invoice_request(batch_request_id, invoice_count=e.stored)
+        return {"success": False, "message": str(e)}
+
+    if not invoice_count:
+        logging.info("No invoices found in the specified date range.")
+    update_invoice_request(batch_request_id, request_status='Ejecutado', progress='completado', invoice_count=invoice_count)
 
-        # Process line items (Conceptos)
-        conceptos = root.find('cfdi:Conceptos', ns)
-        for concepto in conceptos.findall('cfdi:Concepto', ns):
-            item_name = concepto.attrib['Descripcion']
-            quantity = float(concepto.attrib['Cantidad'])
-            rate = float(concepto.attrib['ValorUnitario'])
-
-            # Process taxes for this line item
-            impuestos = concepto.find('cfdi:Impuestos', ns)
-            if impuestos is not None:
-                traslados = impuestos.find('cfdi:Traslados', ns)
-                if traslados is not None:
-                    for traslado in traslados.findall('cfdi:Traslado', ns):
-                        tax_rate = float(traslado.attrib['TasaOCuota']) * 100  # Convert to percentage
-                        tax_amount = float(traslado.attrib['Importe'])
-
-                        # Skip taxes with 0% rate or 0 amount
-                        if tax_rate == 0 or tax_amount == 0:
-                            continue
-
-                        impuesto = traslado.attrib['Impuesto']
-
-                        # Determine the tax name based on 'Impuesto'
-                        if impuesto == '001':
-                            tax_name = "ISR"
-                        elif impuesto == '002':
-                            tax_name = "IVA"
-                        elif impuesto == '003':
-                            tax_name = "IEPS"
-                        else:
-                            tax_name = "Unknown Tax"
-
-                        # Accumulate tax amounts
-                        tax_id = f"{tax_name} ({tax_rate}%)"
-                        if tax_id in tax_totals:
-                            tax_totals[tax_id]['tax_amount'] += tax_amount
-                        else:
-                            tax_totals[tax_id] = {
-                                "tax_name": tax_id,
-                                "tax_amount": tax_amount
-                            }
-
-            # Add the line item to the invoice data
-            line_item = {
-                'item_name': item_name,
-                'quantity': quantity,
-                'rate': rate
-            }
-            invoice_data['line_items'].append(line_item)
+    # Return how many invoices were stored; the documents themselves are served from Mongo
+    return {"success": True, "invoice_count": invoice_count}
 
-        # Add accumulated taxes to the invoice data
-        invoice_data['taxes'] = list(tax_totals.values())
-
-        return invoice_data
-    except ET.ParseError as e:
-        logging.error(f'Error parsing XML file {file_path}: {e}')
-    except Exception as e:
-        logging.error(f'Error processing file {file_path}: {e}')
-        return None
\ No newline at end of file
+def parse_xml_and_get_data_no_zoho(file_path):
+    # Check if TipoDeComprobante is 'I' (for Ingreso - Income invoice)
+    cfdi = parse_cfdi_file(file_path, tipo='I')
+    if cfdi is None:
+        return None
+    return build_invoice(cfdi).to_document()
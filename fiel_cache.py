@@ -0,0 +1,91 @@
+import os
+import time
+import hashlib
+import logging
+
+from cfdiclient import Fiel
+from aws_utils import fetch_from_s3
+from keyed_locks import KeyedLocks
+
+# How long a decrypted e.firma stays in memory before the files are read again (seconds)
+FIEL_CACHE_TTL = float(os.getenv('FIEL_CACHE_TTL', '3600'))
+
+_entries = {}  # (tenant, rfc) -> {'source', 'digest', 'fiel', 'expires_at'}
+_lock_for = KeyedLocks()  # (tenant, rfc) -> Lock, so one e.firma is decrypted once
+
+
+def _sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def _credential_source(client_data):
+    """Identify where the credentials come from without reading them (S3 keys or local paths + mtimes)."""
+    if client_data.get('cerUrl') and client_data.get('keyUrl'):
+        password = client_data.get('cer_pass') or ''
+        return ('s3', client_data['cerUrl'], client_data['keyUrl'], _sha256(password.encode()))
+
+    cer_path = client_data.get('cer_path')
+    key_path = client_data.get('key_path')
+    password = client_data.get('password') or ''
+    return ('local', cer_path, os.path.getmtime(cer_path), key_path, os.path.getmtime(key_path), _sha256(password.encode()))
+
+
+def _read_credentials(client_data):
+    if client_data.get('cerUrl') and client_data.get('keyUrl'):
+        logging.info("Fetching certificate and key files from S3.")
+        cer_der = fetch_from_s3(client_data['cerUrl'])
+        key_der = fetch_from_s3(client_data['keyUrl'])
+        password = client_data['cer_pass']
+    else:
+        logging.info("Fetching certificate and key files from local file system.")
+        with open(client_data['cer_path'], 'rb') as cer_file:
+            cer_der = cer_file.read()
+        with open(client_data['key_path'], 'rb') as key_file:
+            key_der = key_file.read()
+        password = client_data['password']
+
+    if not cer_der or not key_der:
+        raise Exception("Certificate or key data is missing.")
+    return cer_der, key_der, password
+
+
+def load_fiel(client_data):
+    """
+    Return the cfdiclient Fiel for a client, decrypting the private key only when
+    the credential source changed, the cached entry expired, or nothing is cached.
+    Entries live in process memory only and are keyed by tenant and RFC.
+    """
+    key = (client_data.get('tenant'), client_data.get('rfc'))
+    with _lock_for(key):
+        now = time.monotonic()
+        source = _credential_source(client_data)
+        entry = _entries.get(key)
+        if entry and entry['source'] == source and entry['expires_at'] > now:
+            return entry['fiel']
+
+        cer_der, key_der, password = _read_credentials(client_data)
+        digest = _sha256(cer_der + key_der + password.encode())
+        if entry and entry['digest'] == digest:
+            # Same certificate behind a new source or an expired entry: keep the decrypted key
+            fiel = entry['fiel']
+        else:
+            fiel = Fiel(cer_der, key_der, password)
+            logging.info(f"Initialized Fiel object for RFC {key[1]}.")
+
+        _entries[key] = {
+            'source': source,
+            'digest': digest,
+            'fiel': fiel,
+            'expires_at': now + FIEL_CACHE_TTL,
+        }
+        return fiel
+
+
+def invalidate_fiel(tenant=None, rfc=None):
+    """Forget cached e.firma objects for a tenant and/or RFC (call when their credentials change)."""
+    keys = [key for key in list(_entries) if (tenant is None or key[0] == tenant) and (rfc is None or key[1] == rfc)]
+    for key in keys:
+        with _lock_for(key):
+            _entries.pop(key, None)
+    if keys:
+        logging.info(f"Invalidated {len(keys)} cached e.firma entries (tenant={tenant}, rfc={rfc})")
@@ -0,0 +1,111 @@
+import os
+import time
+import logging
+import threading
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Seconds to establish a connection and to wait for a response
+HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', '5'))
+HTTP_READ_TIMEOUT = float(os.getenv('HTTP_READ_TIMEOUT', '60'))
+# Keep-alive connections held per host
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', '16'))
+# Retries of connection errors (any method) and of 5xx answers to idempotent requests
+HTTP_RETRIES = int(os.getenv('HTTP_RETRIES', '3'))
+HTTP_RETRY_BACKOFF = float(os.getenv('HTTP_RETRY_BACKOFF', '0.5'))
+
+_sessions = {}  # scheme://host -> Session
+_sessions_lock = threading.Lock()
+_metrics = {}  # (host, method) -> {'calls', 'errors', 'total_seconds', 'max_seconds'}
+_metrics_lock = threading.Lock()
+
+
+def _new_session():
+    retry = Retry(
+        total=HTTP_RETRIES,
+        connect=HTTP_RETRIES,
+        read=HTTP_RETRIES,
+        status=HTTP_RETRIES,
+        # 429 is left to the caller (zoho_rate_limit paces and retries it per org)
+        status_forcelist=(500, 502, 503, 504),
+        backoff_factor=HTTP_RETRY_BACKOFF,
+        backoff_jitter=HTTP_RETRY_BACKOFF,
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE, max_retries=retry)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def session_for(url):
+    """The shared keep-alive Session of the URL's host, created on first use."""
+    parts = urlsplit(url)
+    origin = f'{parts.scheme}://{parts.netloc}'
+    with _sessions_lock:
+        session = _sessions.get(origin)
+        if session is None:
+            session = _sessions[origin] = _new_session()
+        return session
+
+
+def _record(host, method, seconds, failed):
+    with _metrics_lock:
+        metric = _metrics.setdefault((host, method), {'calls': 0, 'errors': 0, 'total_seconds': 0.0, 'max_seconds': 0.0})
+        metric['calls'] += 1
+        metric['errors'] += failed
+        metric['total_seconds'] += seconds
+        metric['max_seconds'] = max(metric['max_seconds'], seconds)
+
+
+def request(method, url, **kwargs):
+    """
+    requests.request over the host's pooled session, with default timeouts and
+    retries. Latency and failures (exceptions and 5xx) are recorded per host
+    and method; see http_metrics().
+    """
+    kwargs.setdefault('timeout', (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
+    host = urlsplit(url).netloc
+    started = time.perf_counter()
+    failed = True
+    try:
+        response = session_for(url).request(method, url, **kwargs)
+        failed = response.status_code >= 500
+        return response
+    finally:
+        elapsed = time.perf_counter() - started
+        _record(host, method, elapsed, failed)
+        logging.debug(f"HTTP {method} {host} took {elapsed * 1000:.0f} ms")
+
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request('POST', url, **kwargs)
+
+
+def put(url, **kwargs):
+    return request('PUT', url, **kwargs)
+
+
+def http_metrics():
+    """Snapshot of the latency metrics: [{host, method, calls, errors, avg_ms, max_ms}, ...]."""
+    with _metrics_lock:
+        return [
+            {
+                'host': host,
+                'method': method,
+                'calls': metric['calls'],
+                'errors': metric['errors'],
+                'avg_ms': round(metric['total_seconds'] / metric['calls'] * 1000, 1),
+                'max_ms': round(metric['max_seconds'] * 1000, 1),
+            }
+            for (host, method), metric in _metrics.items()
+        ]
@@ -0,0 +1,66 @@
+import sys
+import json
+from dataclasses import dataclass
+
+
+@dataclass
+class LineItem:
+    __slots__ = ('item_name', 'quantity', 'rate')
+    item_name: str
+    quantity: float
+    rate: float
+
+
+@dataclass
+class Tax:
+    __slots__ = ('tax_name', 'tax_amount')
+    tax_name: str
+    tax_amount: float
+
+
+@dataclass
+class Invoice:
+    """
+    Compact form of a parsed CFDI between the parser and MongoDB.
+
+    Slotted instances carry no per-object __dict__ and the strings that repeat
+    across a solicitud (vendor, RFC, tax names, UsoCFDI) are interned, so a large
+    request holds one copy of each. to_document() produces the dataInvoice dict
+    stored in Mongo and served by the API only when a record is written or sent.
+    """
+    __slots__ = ('vendor_name', 'rfc', 'bill_number', 'date', 'uuid', 'uso_cfdi', 'line_items', 'taxes')
+    vendor_name: str
+    rfc: str
+    bill_number: str
+    date: str
+    uuid: str
+    uso_cfdi: str
+    line_items: list
+    taxes: list
+
+    def to_document(self):
+        return {
+            'vendor_name': self.vendor_name,
+            'rfc': self.rfc,
+            'bill_number': self.bill_number,
+            'date': self.date,
+            'line_items': [
+                {'item_name': item.item_name, 'quantity': item.quantity, 'rate': item.rate}
+                for item in self.line_items
+            ],
+            'custom_fields': [
+                {'label': 'IdDocumento', 'value': self.uuid},
+                {'label': 'UsoCFDI', 'value': self.uso_cfdi},
+            ],
+            'taxes': [
+                {'tax_name': tax.tax_name, 'tax_amount': tax.tax_amount}
+                for tax in self.taxes
+            ],
+        }
+
+    def to_json(self):
+        return json.dumps(self.to_document(), ensure_ascii=False, separators=(',', ':'))
+
+
+def intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
@@ -0,0 +1,254 @@
+import os
+import logging
+import threading
+from datetime import datetime
+from itertools import islice
+
+from pymongo import ASCENDING, DESCENDING, InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError
+from db import db, invoices_collection, requests_collection
+
+# Invoice documents sent to MongoDB per bulk write
+INVOICE_INSERT_BATCH_SIZE = int(os.getenv('INVOICE_INSERT_BATCH_SIZE', '500'))
+
+DUPLICATE_KEY = 11000
+LEGACY_REQUESTS_MIGRATION = 'requests_collection'
+
+_indexes_ready = False
+_indexes_lock = threading.Lock()
+
+
+class InvoiceStoreError(Exception):
+    """Raised when a batch could not be written; stored says how many documents landed before it."""
+
+    def __init__(self, message, stored):
+        super().__init__(message)
+        self.stored = stored
+
+
+def iter_batches(items, size=INVOICE_INSERT_BATCH_SIZE):
+    items = iter(items)
+    while True:
+        batch = list(islice(items, size))
+        if not batch:
+            return
+        yield batch
+
+
+def ensure_invoice_indexes():
+    """
+    Create the invoice and request indexes once per process (create_index is a
+    no-op when they exist) and move data stored in the older layout.
+    """
+    global _indexes_ready
+    with _indexes_lock:
+        if _indexes_ready:
+            return
+        try:
+            # One document per fiscal UUID and tenant. Documents stored before the
+            # uuid field existed are left out of the index.
+            invoices_collection.create_index(
+                [('tenant', ASCENDING), ('uuid', ASCENDING)],
+                name='tenant_uuid_unique',
+                unique=True,
+                partialFilterExpression={'uuid': {'$exists': True}},
+            )
+            # Invoices of a request in _id order: request_invoices_filter and the /requests/<id> pages
+            invoices_collection.create_index([('requestIds', ASCENDING), ('_id', ASCENDING)], name='requestIds_id')
+            requests_collection.create_index([('requestId', ASCENDING)], name='requestId_unique', unique=True)
+            requests_collection.create_index([('tenant', ASCENDING), ('created_at', DESCENDING)], name='tenant_created_at')
+            # Older documents belong to the single request that inserted them
+            invoices_collection.update_many(
+                {'dataInvoice': {'$exists': True}, 'requestIds': {'$exists': False}},
+                [{'$set': {'requestIds': ['$requestId']}}],
+            )
+            migrate_legacy_requests()
+            _indexes_ready = True
+        except Exception as e:
+            logging.error(f"Error creating invoice indexes: {e}")
+
+
+def migrate_legacy_requests():
+    """
+    Build the requests collection entries of requests stored before it existed.
+
+    Those requests only live in the invoices collection: a placeholder row (no
+    dataInvoice) with the status of a running or failed request, and invoice rows
+    that repeat start_date, end_date and request_status. They are grouped into one
+    requests entry each, the placeholders are removed and the repeated fields
+    unset. Runs once per database; the result is recorded in db.migrations.
+    """
+    if db.migrations.find_one({'_id': LEGACY_REQUESTS_MIGRATION}):
+        return
+    is_placeholder = {'$eq': [{'$type': '$dataInvoice'}, 'missing']}
+    invoices_collection.aggregate([
+        {'$match': {'requestId': {'$exists': True}, 'start_date': {'$exists': True}}},
+        {'$sort': {'created_at': -1}},
+        {'$group': {
+            '_id': '$requestId',
+            'tenant': {'$first': '$tenant'},
+            'created_at': {'$last': '$created_at'},
+            'updated_at': {'$first': '$created_at'},
+            'start_date': {'$first': '$start_date'},
+            'end_date': {'$first': '$end_date'},
+            'placeholder_status': {'$max': {'$cond': [is_placeholder, '$request_status', None]}},
+            'progress': {'$max': '$progress'},
+            'estado_solicitud': {'$max': '$estado_solicitud'},
+            'error_message': {'$max': '$error_message'},
+            'invoice_count': {'$sum': {'$cond': [is_placeholder, 0, 1]}},
+        }},
+        {'$project': {
+            '_id': 0,
+            'requestId': '$_id',
+            'tenant': 1,
+            'created_at': 1,
+            'updated_at': 1,
+            'start_date': 1,
+            'end_date': 1,
+            'request_status': {'$ifNull': ['$placeholder_status', 'Ejecutado']},
+            'progress': 1,
+            'estado_solicitud': 1,
+            'error_message': 1,
+            'invoice_count': 1,
+        }},
+        {'$merge': {
+            'into': requests_collection.name,
+            'on': 'requestId',
+            'whenMatched': 'keepExisting',
+            'whenNotMatched': 'insert',
+        }},
+    ], allowDiskUse=True)
+    invoices_collection.delete_many({'requestId': {'$exists': True}, 'dataInvoice': {'$exists': False}})
+    invoices_collection.update_many(
+        {'start_date': {'$exists': True}},
+        {'$unset': {'start_date': '', 'end_date': '', 'request_status': ''}},
+    )
+    db.migrations.insert_one({'_id': LEGACY_REQUESTS_MIGRATION, 'applied_at': datetime.utcnow()})
+    logging.info("Requests stored in the invoices collection were moved to the requests collection")
+
+
+def invoice_uuid(invoice):
+    """Normalized fiscal UUID (TimbreFiscalDigital) of an Invoice, or None when it has none."""
+    return invoice.uuid.strip().upper() or None
+
+
+def request_invoices_filter(request_id):
+    """Query for the invoices of a request, including those first stored by another request."""
+    return {'requestIds': request_id}
+
+
+def _write_operation(record):
+    """
+    Upsert keyed on (tenant, uuid): a CFDI already stored by an earlier request is
+    only linked to this one through requestIds, everything else is set on insert.
+    """
+    request_id = record['requestId']
+    if not record.get('uuid'):
+        record['requestIds'] = [request_id]
+        return InsertOne(record)
+    return UpdateOne(
+        {'tenant': record['tenant'], 'uuid': record['uuid']},
+        {'$setOnInsert': record, '$addToSet': {'requestIds': request_id}},
+        upsert=True,
+    )
+
+
+def _write_batch(operations):
+    """Apply a batch unordered and return (stored, linked, failed write errors)."""
+    try:
+        result = invoices_collection.bulk_write(operations, ordered=False)
+        details = result.bulk_api_result
+        write_errors = []
+    except BulkWriteError as e:
+        details = e.details
+        write_errors = details.get('writeErrors', [])
+    stored = details.get('nInserted', 0) + details.get('nUpserted', 0)
+    return stored, details.get('nMatched', 0), write_errors
+
+
+def insert_invoice_batches(invoices, make_record, on_batch=None):
+    """
+    Store invoices as they are produced, INVOICE_INSERT_BATCH_SIZE at a time.
+
+    invoices is any iterable of Invoice objects (typically the parse_invoices
+    generator) and make_record turns one into its Mongo document, so only one
+    batch of documents is held at once. Documents are upserted on (tenant, uuid),
+    so a CFDI returned by overlapping requests is stored once and lists every
+    request in requestIds. Writes are unordered: a failing document does not
+    stop the rest of its batch. on_batch(stored) is called with the running
+    total after every batch. Returns the number of invoices stored or linked.
+    """
+    ensure_invoice_indexes()
+    stored = 0
+    for batch in iter_batches(invoices):
+        operations = []
+        for invoice in batch:
+            record = make_record(invoice)
+            uuid = invoice_uuid(invoice)
+            if uuid:
+                record['uuid'] = uuid
+            operations.append(_write_operation(record))
+        try:
+            inserted, linked, write_errors = _write_batch(operations)
+            # Two requests upserting the same new UUID at once: the loser retries and now matches
+            retry = [operations[error['index']] for error in write_errors if error.get('code') == DUPLICATE_KEY]
+            if retry:
+                write_errors = [error for error in write_errors if error.get('code') != DUPLICATE_KEY]
+                retried, relinked, retry_errors = _write_batch(retry)
+                inserted += retried
+                linked += relinked
+                write_errors += retry_errors
+        except Exception as e:
+            raise InvoiceStoreError(f"Error inserting invoices into MongoDB: {e}", stored) from e
+        stored += inserted + linked
+        if linked:
+            logging.info(f"{linked} invoices were already stored and were linked to this request")
+        if write_errors:
+            logging.error(f"{len(write_errors)} of {len(operations)} invoices in a batch were not stored: {write_errors[:1]}")
+        if on_batch:
+            on_batch(stored)
+    return stored
+
+
+def list_requests(tenant):
+    """The requests of a tenant, newest first, as stored in the requests collection."""
+    return requests_collection.find(
+        {'tenant': tenant},
+        {'_id': 0, 'requestId': 1, 'created_at': 1, 'start_date': 1, 'end_date': 1,
+         'request_status': 1, 'progress': 1, 'invoice_count': 1},
+    ).sort('created_at', DESCENDING)
+
+
+# Fields returned per invoice by /requests/<id>?fields=summary; line items are left out
+SUMMARY_PROJECTION = {
+    'created_at': 1,
+    'status': 1,
+    'uuid': 1,
+    'dataInvoice.vendor_name': 1,
+    'dataInvoice.rfc': 1,
+    'dataInvoice.bill_number': 1,
+    'dataInvoice.date': 1,
+}
+FULL_PROJECTION = {'created_at': 1, 'status': 1, 'uuid': 1, 'dataInvoice': 1}
+
+
+def iter_request_invoices(request_id, after=None, limit=None, summary=False):
+    """
+    Yield the invoices of a request in _id order over the (requestIds, _id) index.
+
+    after is the _id of the last invoice of the previous page, limit bounds the
+    page (None reads to the end) and summary leaves out the line items and taxes.
+    Documents come from the cursor one batch at a time, never as a list.
+    """
+    query = request_invoices_filter(request_id)
+    if after is not None:
+        query['_id'] = {'$gt': after}
+    cursor = invoices_collection.find(query, SUMMARY_PROJECTION if summary else FULL_PROJECTION).sort('_id', ASCENDING)
+    if limit:
+        cursor = cursor.limit(limit)
+    return cursor
+
+
+def get_request(request_id):
+    """The requests collection entry of a request without its Mongo _id, or None."""
+    return requests_collection.find_one({'requestId': request_id}, {'_id': 0})
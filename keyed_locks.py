@@ -0,0 +1,23 @@
+import threading
+
+
+class KeyedLocks:
+    """
+    One threading.Lock per key (an RFC, a (tenant, rfc) pair...), created on
+    first use, so work on one key never waits for another:
+
+        _lock_for = KeyedLocks()
+        with _lock_for(rfc):
+            ...
+    """
+
+    def __init__(self):
+        self._locks = {}
+        self._guard = threading.Lock()
+
+    def __call__(self, key):
+        with self._guard:
+            lock = self._locks.get(key)
+            if lock is None:
+                lock = self._locks[key] = threading.Lock()
+            return lock
@@ -1,25 +1,33 @@
-from flask import Flask, request, jsonify, make_response
+from flask import Flask, request, jsonify, make_response, Response, stream_with_context
 from flask_restful import Api, Resource
 from pymongo import MongoClient
 from werkzeug.utils import secure_filename
 import os
+import json
 from flask_cors import CORS  # Import CORS
 import jwt
 import schedule
 import time
 from threading import Thread
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from fetch_and_send_bills_odoo import fetch_and_send_bills_odoo
 from fetch_and_send_bills_zoho import fetch_and_send_bills_zoho
 import pytz
 from datetime import datetime
 import logging
 from bson.objectid import ObjectId  
+from bson.errors import InvalidId
 from urllib.parse import quote_plus
 from pymongo.errors import ServerSelectionTimeoutError
-from zoho_token_refresh import refresh_zoho_token
-from zoho_utils import check_bill_in_zoho
+from zoho_token_refresh import get_zoho_token
+from zoho_utils import reconcile_bills
+from zoho_async import ZOHO_ASYNC, reconcile_bills_async
+from http_client import http_metrics
 from fetch_and_send_bills_zoho import fetch_and_return_invoices
 from fetch_and_send_bills_zoho import parse_xml_and_get_data_no_zoho
+from sat_jobs import submit_invoice_request
+from fiel_cache import invalidate_fiel
+from invoice_store import ensure_invoice_indexes, request_invoices_filter, iter_request_invoices, list_requests, get_request
 from auth import register, login, update_subscription
 from dotenv import load_dotenv
 from datetime import datetime
@@ -29,6 +37,8 @@ from apscheduler.schedulers.blocking import BlockingScheduler
 from scheduler_script import fetch_and_run_daily_sync
 
 SECRET_KEY = os.getenv("SECRET_KEY")
+# Largest page /requests/<id> returns when ?limit is given
+REQUEST_PAGE_MAX = int(os.getenv('REQUEST_PAGE_MAX', '1000'))
 
 
 
@@ -92,6 +102,9 @@ class ClientResource(Resource):
 
             }
             
+            # New certificate files were uploaded for this RFC
+            invalidate_fiel(rfc=rfc)
+
             # Check if a client with this RFC already exists in the database
             existing_client = collection.find_one({'rfc': rfc})
             if existing_client:
@@ -112,9 +125,9 @@ class TriggerActionResource(Resource):
     def get(self):
         try:
             # Trigger the scheduled task manually
-            scheduled_task()
+            summary = scheduled_task()
             logging.info("Scheduled task triggered successfully")
-            return make_response(jsonify({"message": "Action triggered successfully"}), 200)
+            return make_response(jsonify({"message": "Action triggered successfully", "summary": summary}), 200)
         except Exception as e:
             logging.error(f"Error in TriggerActionResource GET: {str(e)}")
             return make_response(jsonify({"error": str(e)}), 500)
@@ -123,28 +136,65 @@ class TriggerActionResource(Resource):
 api.add_resource(ClientResource, '/client')
 api.add_resource(TriggerActionResource, '/trigger-action')
 
+# Maximum number of clients processed at the same time by the scheduled run
+SCHEDULER_MAX_WORKERS = int(os.getenv('SCHEDULER_MAX_WORKERS', '4'))
+
+def process_client(client):
+    """Run the sync for a single client and return its summary entry; never raises."""
+    rfc = client.get('rfc')
+    solution = client.get('solution')
+    started = time.monotonic()
+    outcome = 'skipped'
+    error = None
+    try:
+        # Log the client being processed
+        logging.info(f"Processing client: {rfc}")
+        # Refresh Zoho token if necessary
+        if solution == 'zoho':
+            client['authtoken'] = get_zoho_token(client, collection)
+            outcome = 'ok' if fetch_and_send_bills_zoho(client) else 'failed'
+        elif solution == 'odoo':
+            outcome = 'ok' if fetch_and_send_bills_odoo(client) else 'failed'
+    except Exception as e:
+        outcome = 'failed'
+        error = str(e)
+        logging.error(f"Error processing client {rfc}: {error}")
+    return {
+        'rfc': rfc,
+        'solution': solution,
+        'outcome': outcome,
+        'error': error,
+        'duration_seconds': round(time.monotonic() - started, 2),
+    }
+
 def scheduled_task():
     logging.info("Starting scheduled task execution")
+    summary = []
     try:
-        # Find all active clients from the database
-        active_clients = collection.find({'status': 'active'})
-        active_count = collection.count_documents({'status': 'active'})
-        logging.info(f"Active clients found: {active_count}")
-        for client in active_clients:
-            solution = client['solution']
-            # Log the client being processed
-            logging.info(f"Processing client: {client['rfc']}")
-            # Refresh Zoho token if necessary
-            if solution == 'zoho':
-                auth_token, new_refresh_time = refresh_zoho_token(client, collection)
-                client['authtoken'] = auth_token
-                client['last_refresh_time'] = new_refresh_time
-                fetch_and_send_bills_zoho(client)
-            elif solution == 'odoo':
-                fetch_and_send_bills_odoo(client)
-        logging.info("Scheduled task executed for active clients")
+        started = time.monotonic()
+        # Find all active clients from the database; one entry per RFC so a tenant never runs twice in parallel
+        active_clients = {}
+        for client in collection.find({'status': 'active'}):
+            active_clients.setdefault(client.get('rfc'), client)
+        logging.info(f"Active clients found: {len(active_clients)}")
+
+        with ThreadPoolExecutor(max_workers=SCHEDULER_MAX_WORKERS, thread_name_prefix='sync-client') as executor:
+            futures = [executor.submit(process_client, client) for client in active_clients.values()]
+            for future in as_completed(futures):
+                result = future.result()
+                summary.append(result)
+                logging.info(f"Client {result['rfc']} finished: {result['outcome']} in {result['duration_seconds']}s")
+
+        failed = sum(1 for result in summary if result['outcome'] == 'failed')
+        logging.info(
+            f"Scheduled task executed for {len(summary)} active clients in {round(time.monotonic() - started, 2)}s "
+            f"({failed} failed, concurrency {SCHEDULER_MAX_WORKERS})"
+        )
+        for metric in http_metrics():
+            logging.info(f"HTTP {metric['method']} {metric['host']}: {metric['calls']} calls, {metric['errors']} errors, avg {metric['avg_ms']} ms, max {metric['max_ms']} ms")
     except Exception as e:
         logging.error(f"Error during scheduled task: {str(e)}")
+    return summary
 
 def run_scheduled_task():
     # Set the desired timezone for scheduling
@@ -158,9 +208,27 @@ def run_scheduled_task():
         schedule.run_pending()
         time.sleep(1)
 
-# Start the scheduler in a separate thread
-scheduler_thread = Thread(target=run_scheduled_task)
-scheduler_thread.start()
+_services_started = False
+
+
+def start_background_services():
+    """
+    Create the invoice indexes and start the scheduler thread. Called by the
+    server entry points (python main.py and passenger_wsgi.py) rather than at
+    import time: the cfdi_pool parse workers are spawned processes, which import
+    the parent's __main__ again, and must not start schedulers of their own.
+    """
+    global _services_started
+    if _services_started:
+        return
+    _services_started = True
+
+    # Indexes the invoice listings and the deduplicating writes rely on
+    ensure_invoice_indexes()
+
+    # Start the scheduler in a separate thread
+    scheduler_thread = Thread(target=run_scheduled_task)
+    scheduler_thread.start()
 
 class InvoicesResource(Resource):
     def get(self):
@@ -214,15 +282,10 @@ class InvoicesResource(Resource):
             if not client:
                 return make_response(jsonify({"error": f"No active client found with RFC: {rfc}"}), 404)
             
-            # Fetch the list of invoices from SAT within the provided date range
-
-            invoices = fetch_and_return_invoices(client, start_date, end_date)
+            # Queue the SAT download for the provided date range; progress is polled on /requests/<requestId>
+            request_id = submit_invoice_request(client, start_date, end_date)
 
-            if not invoices:
-                return make_response(jsonify({"message": "No invoices found in the specified date range"}), 404)
-
-            # Return the list of invoices as JSON
-            return make_response(jsonify(invoices), 200)
+            return make_response(jsonify({"requestId": request_id, "request_status": "Pendiente"}), 202)
 
         except Exception as e:
             logging.error(f"Error fetching invoices: {e}")
@@ -278,67 +341,20 @@ class AllInvoicesResource(Resource):
             if not client:
                 return make_response(jsonify({"error": "No client found for this user and tenant."}), 404)
 
-            # Fetch all invoices associated with this tenant
-            invoice_list = invoices_collection.find({'tenant': tenant})
-
-            # Group invoices by requestId and keep the first or last invoice for each requestId
-            grouped_invoices = {}
-            for invoice in invoice_list:
-                request_id = invoice.get('requestId')
-                created_at = invoice.get('created_at')
-                start_date = invoice.get('start_date')
-                end_date = invoice.get('end_date')
-                request_status = invoice.get('request_status')
-
-                if request_id:
-                    # If `created_at` is a datetime, format it
-                    if isinstance(created_at, datetime):
-                        formatted_date = created_at.strftime('%Y-%m-%d')
-                    elif isinstance(created_at, str):
-                        try:
-                            created_at = datetime.strptime(created_at, "%a, %d %b %Y %H:%M:%S %Z")
-                            formatted_date = created_at.strftime('%Y-%m-%d')
-                        except ValueError:
-                            formatted_date = created_at  # If date format is unexpected, leave as-is
-                    else:
-                        formatted_date = None  # Handle unexpected `created_at` formats
-
-                    # Check if the request_id is already in the dictionary
-                    if request_id not in grouped_invoices:
-                        # If not, add the first invoice found
-                        grouped_invoices[request_id] = {
-                            'created_at': formatted_date,
-                            'requestId': request_id,
-                            'start_date': start_date,
-                            'end_date': end_date,
-                            'request_status' : request_status,
-                            'count': 1
-                        }
-                    else:
-                        # Compare `created_at` to keep the latest invoice if needed
-                        existing_created_at = grouped_invoices[request_id]['created_at']
-
-                        if isinstance(existing_created_at, str):
-                            try:
-                                existing_created_at = datetime.strptime(existing_created_at, '%Y-%m-%d')
-                            except ValueError:
-                                pass  # If parsing fails, leave as string
-
-                        # Update with the latest `created_at` and increment count
-                        if created_at and isinstance(created_at, datetime) and created_at > existing_created_at:
-                            grouped_invoices[request_id] = {
-                                'created_at': formatted_date,
-                                'requestId': request_id,
-                                'start_date': start_date,
-                                'end_date': end_date,
-                                'request_status' : request_status,
-                                'count': grouped_invoices[request_id]['count'] + 1
-                            }
-                        else:
-                            grouped_invoices[request_id]['count'] += 1
-
-            # Convert the dictionary to a list of unique requestIds with their first or last invoice
-            unique_invoices = list(grouped_invoices.values())
+            # One entry per request, read from the requests collection
+            unique_invoices = []
+            for summary in list_requests(tenant):
+                created_at = summary.get('created_at')
+                # If `created_at` is a datetime, format it
+                if isinstance(created_at, datetime):
+                    summary['created_at'] = created_at.strftime('%Y-%m-%d')
+                elif isinstance(created_at, str):
+                    try:
+                        summary['created_at'] = datetime.strptime(created_at, "%a, %d %b %Y %H:%M:%S %Z").strftime('%Y-%m-%d')
+                    except ValueError:
+                        pass  # If date format is unexpected, leave as-is
+                summary['count'] = summary.pop('invoice_count', 0)
+                unique_invoices.append(summary)
 
             # Return the unique requestId list as JSON
             return make_response(jsonify(unique_invoices), 200)
@@ -358,36 +374,81 @@ class InvoicesByRequestIdResource(Resource):
             # Fetch all invoices for the specific requestId
             logging.info(f"Fetching all invoices for requestId={request_id}")
 
-            # Fetch invoices from MongoDB
-            invoices = invoices_collection.find({'requestId': request_id})
+            request_state = get_request(request_id)
+            if request_state is None:
+                return make_response(jsonify({"error": "No invoices found for this requestId."}), 404)
 
-            # Convert cursor to list and process `created_at` field
-            invoice_list = []
-            found_invoices = False  # Flag to track if any invoices were found
+            # Nothing stored yet (still running, failed or empty): report the job status instead of invoices
+            if not request_state.get('invoice_count'):
+                return make_response(jsonify({
+                    'requestId': request_state['requestId'],
+                    'request_status': request_state.get('request_status'),
+                    'progress': request_state.get('progress'),
+                    'estado_solicitud': request_state.get('estado_solicitud'),
+                    'error_message': request_state.get('error_message'),
+                    'start_date': request_state.get('start_date'),
+                    'end_date': request_state.get('end_date'),
+                }), 200)
+
+            # Optional paging: ?limit=N&cursor=<last _id of the previous page>; ?fields=summary drops line items
+            summary = request.args.get('fields', 'full') == 'summary'
+            after = request.args.get('cursor')
+            limit = request.args.get('limit')
+            try:
+                after = ObjectId(after) if after else None
+                limit = min(int(limit), REQUEST_PAGE_MAX) if limit else None
+            except (InvalidId, ValueError):
+                return make_response(jsonify({"error": "Invalid cursor or limit"}), 400)
+            if limit is not None and limit <= 0:
+                return make_response(jsonify({"error": "Invalid cursor or limit"}), 400)
 
-            for invoice in invoices:
-                found_invoices = True
+            # A deduplicated invoice lists every request that returned it
+            invoices = iter_request_invoices(request_id, after, limit, summary)
+
+            def invoice_entry(invoice):
                 # Check if `created_at` is a datetime object and format it to 'YYYY-MM-DD'
                 if isinstance(invoice['created_at'], datetime):
                     created_at = invoice['created_at'].strftime('%Y-%m-%d')
                 else:
                     created_at = invoice['created_at']  # In case it's already a string
-
-                # Append invoice data to the list
-                invoice_list.append({
+                entry = {
                     'created_at': created_at,
-                    'requestId': invoice['requestId'],
+                    'requestId': request_id,
                     'dataInvoice': invoice['dataInvoice'],
-                    'start_date' : invoice.get('start_date'),
-                    'end_date' : invoice.get('end_date'),
-                })
-
-            # Check if no invoices were found
-            if not found_invoices:
-                return make_response(jsonify({"error": "No invoices found for this requestId."}), 404)
+                    'start_date' : request_state.get('start_date'),
+                    'end_date' : request_state.get('end_date'),
+                }
+                if summary:
+                    entry['uuid'] = invoice.get('uuid')
+                    entry['status'] = invoice.get('status')
+                return json.dumps(entry, default=str)
+
+            def stream():
+                # The response is written one invoice at a time instead of building the whole list
+                separator = ''
+                last_id = None
+                count = 0
+                if limit is not None:
+                    yield '{"invoices":['
+                else:
+                    yield '['
+                try:
+                    for invoice in invoices:
+                        yield separator + invoice_entry(invoice)
+                        separator = ','
+                        last_id = invoice['_id']
+                        count += 1
+                finally:
+                    invoices.close()
+                if limit is not None:
+                    # A full page may be followed by more; pass next_cursor back to get it
+                    next_cursor = str(last_id) if count == limit else None
+                    yield '],"next_cursor":' + json.dumps(next_cursor) + '}'
+                else:
+                    yield ']'
 
-            # Return the list of invoices as JSON
-            return make_response(jsonify(invoice_list), 200)
+            # Without ?limit the response is the same JSON list as before, streamed
+            return Response(stream_with_context(stream()), status=200, mimetype='application/json')
 
         except Exception as e:
             logging.error(f"Error fetching invoices for requestId {request_id}: {e}")
@@ -418,32 +479,32 @@ class CheckZohoResource(Resource):
             if not client:
                 return make_response(jsonify({"error": "No client found for this user and tenant."}), 404)
 
-            # Refresh Zoho token
-            auth_token, refresh_time  = refresh_zoho_token(client, collection)
-            logging.info(f"Zoho token refreshed for requestId {auth_token}")
+            # Valid Zoho token, shared with the scheduler and refreshed only near expiry
+            auth_token = get_zoho_token(client, collection)
 
             # Fetch all invoices for the specific requestId
-            invoices = invoices_collection.find({'requestId': request_id})
+            invoices = list(invoices_collection.find(request_invoices_filter(request_id)))
 
             # Check if there are any invoices
-            if invoices_collection.count_documents({'requestId': request_id}) == 0:
+            if not invoices:
                 return make_response(jsonify({"error": "No invoices found for this requestId."}), 404)
 
-            zoho_url = "https://books.zoho.com/api/v3/"
             org_id = client['org_id']
             dias_tolerancia = client.get('toleranceDays', 5)
 
-            # Check each invoice in Zoho and update with status
-            invoice_results = []
+            # Match every invoice against the org's bills for the covered dates, fetched in a few pages
+            lookups = []
             for invoice in invoices:
-                rfc = invoice['dataInvoice']['rfc']
-                invoice_date = invoice['dataInvoice']['date']
-                contact_name = invoice['dataInvoice']['vendor_name']
                 amount = sum(item['rate'] for item in invoice['dataInvoice']['line_items'])
-                
-                # Check in Zoho
-                exists_in_zoho = check_bill_in_zoho(rfc, contact_name, amount,invoice_date, org_id, auth_token, zoho_url, dias_tolerancia)
+                lookups.append((invoice['dataInvoice']['vendor_name'], amount, invoice['dataInvoice']['date']))
+            if ZOHO_ASYNC:
+                matches = reconcile_bills_async(lookups, org_id, auth_token, dias_tolerancia)
+            else:
+                matches = reconcile_bills(lookups, org_id, auth_token, dias_tolerancia)
 
+            # Check each invoice in Zoho and update with status
+            invoice_results = []
+            for invoice, (_, amount, _), exists_in_zoho in zip(invoices, lookups, matches):
                 if exists_in_zoho is True:
                     existe = "Si"
                 else:
@@ -452,10 +513,10 @@ class CheckZohoResource(Resource):
                 # Append results
                 invoice_results.append({
                     'created_at': invoice.get('created_at'),
-                    'requestId': invoice.get('requestId'),
+                    'requestId': request_id,
                     'status': existe,
                     'amount': amount,
-                    'rfc': rfc,
+                    'rfc': invoice['dataInvoice']['rfc'],
                     'dataInvoice': invoice.get('dataInvoice')
                 })
 
@@ -514,6 +575,10 @@ class EditClientResource(Resource):
                 {'$set': updated_data}
             )
 
+            # Drop the cached e.firma so the next SAT request uses the new credentials
+            if any(field in updated_data for field in ('rfc', 'cerUrl', 'keyUrl', 'cer_pass')):
+                invalidate_fiel(tenant=tenant)
+
             logging.info(f"Client {user_id} updated with data: {updated_data}")
             return make_response(jsonify({"message": "Client data updated successfully"}), 200)
 
@@ -588,6 +653,7 @@ def run_scheduler():
 
 
 if __name__ == '__main__':
+    start_background_services()
     app.run(debug=True)
     logging.basicConfig(level=logging.INFO)
     """
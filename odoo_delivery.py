@@ -0,0 +1,168 @@
+import os
+import gzip
+import json
+import time
+import random
+import logging
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import http_client
+from odoo_jsonrpc import OdooRpcError, client_for
+from pymongo import ASCENDING, UpdateOne
+from db import db
+
+# Delivery state of every bill sent to an Odoo instance, so a rerun only resends what failed
+odoo_deliveries_collection = db['odoo_deliveries']
+
+# Bills per request: one POST to /api/receive_bills or one account.move create
+ODOO_CHUNK_SIZE = int(os.getenv('ODOO_CHUNK_SIZE', '100'))
+# Chunks posted at the same time across all clients
+ODOO_DELIVERY_WORKERS = int(os.getenv('ODOO_DELIVERY_WORKERS', '4'))
+# Attempts per chunk, with exponential backoff and jitter between them
+ODOO_CHUNK_RETRIES = int(os.getenv('ODOO_CHUNK_RETRIES', '3'))
+ODOO_RETRY_DELAY = float(os.getenv('ODOO_RETRY_DELAY', '2'))
+# Gzip request bodies only for clients whose document sets odoo_gzip to true: neither
+# Werkzeug nor Odoo decompresses request bodies, so the receiving module must do it
+ODOO_GZIP = os.getenv('ODOO_GZIP', '0') == '1'
+
+_executor = ThreadPoolExecutor(max_workers=ODOO_DELIVERY_WORKERS, thread_name_prefix='odoo-delivery')
+_indexes_ready = False
+_indexes_lock = threading.Lock()
+
+
+def _ensure_indexes():
+    global _indexes_ready
+    with _indexes_lock:
+        if not _indexes_ready:
+            odoo_deliveries_collection.create_index(
+                [('rfc', ASCENDING), ('bill_key', ASCENDING)],
+                name='rfc_bill_key_unique',
+                unique=True,
+            )
+            _indexes_ready = True
+
+
+def bill_key(bill):
+    """Folio fiscal of a bill, or partner VAT and folio when the CFDI had no UUID."""
+    if bill.get('folio_fiscal') and bill['folio_fiscal'] != 'N/A':
+        return bill['folio_fiscal']
+    return f"{bill['partner_id']['vat']}:{bill['name']}"
+
+
+def post_bills(bills, odoo_url, compress=ODOO_GZIP):
+    """POST one chunk of bills to /api/receive_bills. Returns (ok, error message)."""
+    body = json.dumps({'bills': bills}).encode('utf-8')
+    headers = {'Content-Type': 'application/json'}
+    if compress:
+        body = gzip.compress(body)
+        headers['Content-Encoding'] = 'gzip'
+    response = http_client.post(f"{odoo_url}/api/receive_bills", data=body, headers=headers)
+    if response.status_code in (200, 201):
+        return True, None
+    return False, f"Status Code: {response.status_code}, Response: {response.text[:500]}"
+
+
+def _record(rfc, bills, status, error=None):
+    now = datetime.utcnow()
+    update = {'$set': {'status': status, 'updated_at': now, 'last_error': error}}
+    if status != 'pending':
+        update['$inc'] = {'attempts': 1}
+    try:
+        odoo_deliveries_collection.bulk_write([
+            UpdateOne(
+                {'rfc': rfc, 'bill_key': bill_key(bill)},
+                {**update, '$setOnInsert': {'name': bill['name'], 'created_at': now}},
+                upsert=True,
+            )
+            for bill in bills
+        ], ordered=False)
+    except Exception as e:
+        logging.error(f"Error recording Odoo delivery status for {rfc}: {e}")
+
+
+def create_bills_jsonrpc(bills, client_data, retry=False):
+    """
+    Create one chunk of bills through Odoo's JSON-RPC execute_kw. Returns (ok, error message).
+    With retry, moves a timed-out attempt already committed are found by folio fiscal, not created again.
+    """
+    try:
+        ids = client_for(client_data).create_bills(bills, client_data.get('odoo_uuid_field'), retry)
+        return len(ids) == len(bills), None
+    except OdooRpcError as e:
+        return False, str(e)
+
+
+def _sender(client_data):
+    """send(chunk, retry) of the client's transport: odoo_transport 'jsonrpc', or the /api/receive_bills module."""
+    if client_data.get('odoo_transport') == 'jsonrpc':
+        return lambda chunk, retry: create_bills_jsonrpc(chunk, client_data, retry)
+    compress = client_data.get('odoo_gzip', ODOO_GZIP)
+    return lambda chunk, retry: post_bills(chunk, client_data['odoo_url'], compress)
+
+
+def _deliver_chunk(rfc, chunk, send):
+    error = None
+    for attempt in range(1, ODOO_CHUNK_RETRIES + 1):
+        try:
+            ok, error = send(chunk, attempt > 1)
+        except Exception as e:
+            ok, error = False, str(e)
+        if ok:
+            _record(rfc, chunk, 'sent')
+            logging.info(f"Delivered {len(chunk)} bills to Odoo for {rfc} (attempt {attempt})")
+            return True
+        if attempt < ODOO_CHUNK_RETRIES:
+            delay = ODOO_RETRY_DELAY * 2 ** (attempt - 1) * (1 + random.random())
+            logging.warning(f"Failed to deliver {len(chunk)} bills to Odoo for {rfc} (attempt {attempt}), retrying in {delay:.1f}s: {error}")
+            time.sleep(delay)
+    logging.error(f"Failed to deliver {len(chunk)} bills to Odoo for {rfc}: {error}")
+    _record(rfc, chunk, 'failed', error)
+    return False
+
+
+def deliver_bills(bills, client_data, chunk_size=ODOO_CHUNK_SIZE):
+    """
+    Send bills to the client's Odoo in chunks posted concurrently, through the
+    custom /api/receive_bills endpoint or, with odoo_transport 'jsonrpc', as
+    account.move creates over execute_kw.
+
+    None entries (CFDIs that failed to parse) are dropped and bills already
+    delivered on an earlier run are skipped. Each chunk is retried on its own,
+    so a failure only resends that chunk, and every bill's outcome is kept in
+    odoo_deliveries. Returns (delivered, failed) bill counts.
+    """
+    rfc = client_data['rfc']
+    send = _sender(client_data)
+    bills = [bill for bill in bills if bill is not None]
+
+    try:
+        _ensure_indexes()
+        keys = [bill_key(bill) for bill in bills]
+        delivered = {
+            document['bill_key']
+            for document in odoo_deliveries_collection.find(
+                {'rfc': rfc, 'bill_key': {'$in': keys}, 'status': 'sent'}, {'bill_key': 1}
+            )
+        }
+    except Exception as e:
+        logging.error(f"Error reading Odoo delivery status for {rfc}: {e}")
+        delivered = set()
+    pending = [bill for bill in bills if bill_key(bill) not in delivered]
+    if len(pending) < len(bills):
+        logging.info(f"Skipping {len(bills) - len(pending)} bills already delivered to Odoo for {rfc}")
+    if not pending:
+        return 0, 0
+    _record(rfc, pending, 'pending')
+
+    chunks = [pending[start:start + chunk_size] for start in range(0, len(pending), chunk_size)]
+    futures = {_executor.submit(_deliver_chunk, rfc, chunk, send): chunk for chunk in chunks}
+    sent = failed = 0
+    for future in as_completed(futures):
+        if future.result():
+            sent += len(futures[future])
+        else:
+            failed += len(futures[future])
+    logging.info(f"Odoo delivery for {rfc}: {sent} bills sent, {failed} failed in {len(chunks)} chunks")
+    return sent, failed
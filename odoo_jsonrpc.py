@@ -0,0 +1,160 @@
+import os
+import itertools
+import logging
+import threading
+
+import http_client
+
+# Partners looked up or created per execute_kw call
+ODOO_PARTNER_BATCH_SIZE = int(os.getenv('ODOO_PARTNER_BATCH_SIZE', '200'))
+# Move field that stores the folio fiscal when the client document sets no odoo_uuid_field
+DEFAULT_UUID_FIELD = 'payment_reference'
+# folio_fiscal of CFDIs without a TimbreFiscalDigital UUID
+MISSING_UUIDS = (None, '', 'N/A')
+
+_request_ids = itertools.count(1)
+
+
+class OdooRpcError(Exception):
+    """Raised when Odoo answers a JSON-RPC call with an error."""
+
+
+class OdooJsonRpc:
+    """
+    Odoo's standard external API (/jsonrpc, execute_kw) for instances without
+    the custom /api/receive_bills module. Logs in once, keeps the uid and caches
+    partner ids by VAT for the life of the object.
+    """
+
+    def __init__(self, url, db, username, password):
+        self.url = url.rstrip('/')
+        self.db = db
+        self.username = username
+        self.password = password
+        self._uid = None
+        self._partners = {}  # VAT -> res.partner id
+        self._lock = threading.Lock()
+        # Chunks of one client are created concurrently; a new VAT must only be created once
+        self._partners_lock = threading.Lock()
+
+    def call(self, service, method, *args):
+        response = http_client.post(f"{self.url}/jsonrpc", json={
+            'jsonrpc': '2.0',
+            'method': 'call',
+            'params': {'service': service, 'method': method, 'args': args},
+            'id': next(_request_ids),
+        })
+        if response.status_code != 200:
+            raise OdooRpcError(f"Status Code: {response.status_code}, Response: {response.text[:500]}")
+        body = response.json()
+        if body.get('error'):
+            error = body['error']
+            raise OdooRpcError(error.get('data', {}).get('message') or error.get('message'))
+        return body.get('result')
+
+    @property
+    def uid(self):
+        with self._lock:
+            if self._uid is None:
+                self._uid = self.call('common', 'authenticate', self.db, self.username, self.password, {})
+                if not self._uid:
+                    raise OdooRpcError(f"Authentication failed for {self.username} on {self.db}")
+            return self._uid
+
+    def execute_kw(self, model, method, args, kwargs=None):
+        return self.call('object', 'execute_kw', self.db, self.uid, self.password, model, method, args, kwargs or {})
+
+    def partner_ids(self, partners):
+        """
+        {vat: partner id} for {vat: name}. VATs not cached yet are searched in
+        one search_read per batch and the ones Odoo does not know are created
+        with a single create on the list of values.
+        """
+        with self._partners_lock:
+            return self._partner_ids(partners)
+
+    def _partner_ids(self, partners):
+        missing = [vat for vat in partners if vat not in self._partners]
+        for start in range(0, len(missing), ODOO_PARTNER_BATCH_SIZE):
+            batch = missing[start:start + ODOO_PARTNER_BATCH_SIZE]
+            for partner in self.execute_kw('res.partner', 'search_read', [[['vat', 'in', batch]]], {'fields': ['id', 'vat']}):
+                self._partners.setdefault(partner['vat'], partner['id'])
+            to_create = [vat for vat in batch if vat not in self._partners]
+            if to_create:
+                created = self.execute_kw('res.partner', 'create', [[
+                    {'name': partners[vat], 'vat': vat, 'supplier_rank': 1} for vat in to_create
+                ]])
+                self._partners.update(zip(to_create, created))
+                logging.info(f"Created {len(created)} partners in Odoo {self.db}")
+        return {vat: self._partners[vat] for vat in partners}
+
+    def existing_moves(self, moves, uuid_field):
+        """
+        {index in moves: account.move id} for the moves already in Odoo, matched
+        only on the folio fiscal stored in uuid_field. Moves without a real UUID
+        are never matched: folios repeat across CFDIs and default to 'N/A'.
+        """
+        uuids = [move[uuid_field] for move in moves if move.get(uuid_field) not in MISSING_UUIDS]
+        if not uuids:
+            return {}
+        by_uuid = {
+            found[uuid_field]: found['id']
+            for found in self.execute_kw(
+                'account.move', 'search_read',
+                [[['move_type', '=', 'in_invoice'], [uuid_field, 'in', uuids]]],
+                {'fields': ['id', uuid_field]},
+            )
+        }
+        return {
+            index: by_uuid[move[uuid_field]]
+            for index, move in enumerate(moves)
+            if move.get(uuid_field) in by_uuid
+        }
+
+    def create_bills(self, bills, uuid_field=None, retry=False):
+        """
+        Create the bill dicts built by fetch_and_send_bills_odoo as account.move
+        records with one create call and return the ids of all of them. The folio
+        fiscal is written to uuid_field (payment_reference unless the instance has
+        a field of its own). A create that timed out may still have been committed,
+        so on a retry the moves already in Odoo (see existing_moves) are not
+        created again.
+        """
+        uuid_field = uuid_field or DEFAULT_UUID_FIELD
+        partner_ids = self.partner_ids({bill['partner_id']['vat']: bill['partner_id']['name'] for bill in bills})
+        moves = []
+        for bill in bills:
+            move = {
+                'move_type': bill['move_type'],
+                'partner_id': partner_ids[bill['partner_id']['vat']],
+                'journal_id': bill['journal_id'],
+                'ref': bill['name'],
+                'invoice_date': bill['invoice_date'][:10],
+                'invoice_line_ids': [(0, 0, line) for line in bill['invoice_line_ids']],
+            }
+            if bill['folio_fiscal'] not in MISSING_UUIDS:
+                move[uuid_field] = bill['folio_fiscal']
+            moves.append(move)
+
+        existing = self.existing_moves(moves, uuid_field) if retry else {}
+        if existing:
+            logging.info(f"Skipping {len(existing)} bills already in Odoo {self.db}")
+        missing = [move for index, move in enumerate(moves) if index not in existing]
+        created = self.execute_kw('account.move', 'create', [missing]) if missing else []
+        return list(existing.values()) + created
+
+
+_clients = {}  # (url, db, username) -> OdooJsonRpc
+_clients_lock = threading.Lock()
+
+
+def client_for(client_data):
+    """The shared OdooJsonRpc of a client document, so partner ids stay cached across runs of the process."""
+    key = (client_data['odoo_url'], client_data['odoo_db'], client_data['odoo_username'])
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None or client.password != client_data['odoo_password']:
+            client = _clients[key] = OdooJsonRpc(
+                client_data['odoo_url'], client_data['odoo_db'], client_data['odoo_username'], client_data['odoo_password']
+            )
+        return client
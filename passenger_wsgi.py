@@ -5,4 +5,7 @@ import os
 sys.path.insert(0, '/home/watcphbh/public_html/satsync')
 
 # Import the Flask app
-from main import app as application
+from main import app as application, start_background_services
+
+# Indexes and the scheduler thread are started here, not when main is imported
+start_background_services()
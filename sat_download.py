@@ -0,0 +1,132 @@
+import io
+import os
+import time
+import base64
+import zipfile
+import logging
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from cfdiclient import DescargaMasiva
+from sat_token_cache import get_sat_token, invalidate_sat_token
+
+# Package downloads running at the same time across all RFCs
+SAT_DOWNLOAD_WORKERS = int(os.getenv('SAT_DOWNLOAD_WORKERS', '8'))
+# Package downloads running at the same time for a single RFC
+SAT_DOWNLOADS_PER_RFC = int(os.getenv('SAT_DOWNLOADS_PER_RFC', '3'))
+# Attempts per package before giving up, with exponential backoff between them
+SAT_DOWNLOAD_RETRIES = int(os.getenv('SAT_DOWNLOAD_RETRIES', '3'))
+SAT_DOWNLOAD_RETRY_DELAY = float(os.getenv('SAT_DOWNLOAD_RETRY_DELAY', '2'))
+# Characters of base64 decoded per step (multiple of 4)
+B64_CHUNK_SIZE = 4 * 256 * 1024
+
+_executor = ThreadPoolExecutor(max_workers=SAT_DOWNLOAD_WORKERS, thread_name_prefix='sat-download')
+_rfc_slots = {}  # rfc -> BoundedSemaphore
+_rfc_slots_guard = threading.Lock()
+
+
+def _slots_for(rfc):
+    with _rfc_slots_guard:
+        slots = _rfc_slots.get(rfc)
+        if slots is None:
+            slots = _rfc_slots[rfc] = threading.BoundedSemaphore(SAT_DOWNLOADS_PER_RFC)
+        return slots
+
+
+def download_paquete(fiel, rfc, paquete):
+    """Download one package and return its base64 payload, retrying transient failures."""
+    for attempt in range(1, SAT_DOWNLOAD_RETRIES + 1):
+        try:
+            token = get_sat_token(fiel, rfc)
+            descarga = DescargaMasiva(fiel).descargar_paquete(token, rfc, paquete)
+            paquete_b64 = descarga.get('paquete_b64', '')
+            if not paquete_b64:
+                raise Exception(f"No 'paquete_b64' found for paquete: {paquete}")
+            logging.info(f'Descarga package: {paquete}')
+            return paquete_b64
+        except Exception as e:
+            if attempt == SAT_DOWNLOAD_RETRIES:
+                raise
+            delay = SAT_DOWNLOAD_RETRY_DELAY * 2 ** (attempt - 1)
+            logging.warning(f"Error downloading paquete {paquete} (attempt {attempt}), retrying in {delay}s: {e}")
+            invalidate_sat_token(rfc)
+            time.sleep(delay)
+
+
+def download_paquetes(fiel, rfc, paquetes):
+    """
+    Download the packages of a solicitud concurrently and yield (paquete, paquete_b64)
+    as each one finishes. Packages that still fail after retries yield None.
+
+    At most SAT_DOWNLOADS_PER_RFC packages of the RFC are submitted at a time: the
+    slot is taken here, before submitting, so pool workers never block on it and
+    other RFCs keep the rest of the pool. A new package is only submitted once the
+    caller has consumed a finished one, so payloads waiting to be parsed stay bounded.
+    """
+    slots = _slots_for(rfc)
+    pending = iter(paquetes)
+    in_flight = {}
+
+    def submit_next():
+        paquete = next(pending, None)
+        if paquete is None:
+            return False
+        slots.acquire()
+        try:
+            future = _executor.submit(download_paquete, fiel, rfc, paquete)
+        except Exception:
+            slots.release()
+            raise
+        future.add_done_callback(lambda _: slots.release())
+        in_flight[future] = paquete
+        return True
+
+    while len(in_flight) < SAT_DOWNLOADS_PER_RFC and submit_next():
+        pass
+    while in_flight:
+        done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+        for future in done:
+            paquete = in_flight.pop(future)
+            try:
+                yield paquete, future.result()
+            except Exception as e:
+                logging.error(f"Error downloading paquete {paquete}: {e}")
+                yield paquete, None
+            submit_next()
+
+
+def decode_paquete(paquete_b64, chunk_size=B64_CHUNK_SIZE):
+    """Decode a base64 package into an in-memory buffer a chunk at a time."""
+    buffer = io.BytesIO()
+    if any(char in paquete_b64 for char in '\r\n '):
+        # Wrapped payloads cannot be split on fixed offsets
+        buffer.write(base64.b64decode(paquete_b64))
+    else:
+        for start in range(0, len(paquete_b64), chunk_size):
+            buffer.write(base64.b64decode(paquete_b64[start:start + chunk_size]))
+    buffer.seek(0)
+    return buffer
+
+
+def iter_paquete_xml(paquete_b64):
+    """
+    Yield (name, file object) for every XML inside a downloaded package without
+    touching the disk. Each member is decompressed as it is read, so the caller
+    should consume it before advancing the generator.
+    """
+    try:
+        with zipfile.ZipFile(decode_paquete(paquete_b64)) as zip_ref:
+            for member in zip_ref.infolist():
+                if member.filename.endswith('.xml'):
+                    with zip_ref.open(member) as xml_file:
+                        yield member.filename, xml_file
+    except zipfile.BadZipFile:
+        logging.error('Error: downloaded paquete is not a valid zip file')
+
+
+def iter_solicitud_xml(fiel, rfc, paquetes):
+    """Download the packages of a solicitud concurrently and yield (name, file object) for each XML."""
+    for paquete, paquete_b64 in download_paquetes(fiel, rfc, paquetes):
+        if not paquete_b64:
+            continue  # Skip this paquete if no data
+        yield from iter_paquete_xml(paquete_b64)
@@ -0,0 +1,39 @@
+import os
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from fetch_and_send_bills_zoho import create_invoice_request, update_invoice_request, fetch_invoices_async
+
+# Number of SAT download jobs that can run at the same time in this process
+SAT_JOB_WORKERS = int(os.getenv('SAT_JOB_WORKERS', '4'))
+
+_executor = ThreadPoolExecutor(max_workers=SAT_JOB_WORKERS, thread_name_prefix='sat-job')
+
+
+def submit_invoice_request(client_data, start_date, end_date):
+    """
+    Create the request entry and hand the solicitar/verificar/descargar
+    lifecycle to the background pool and the shared SAT poller. Returns the requestId right away; progress
+    is written to the requests collection and can be polled on /requests/<id>.
+    """
+    request_id = create_invoice_request(client_data, start_date, end_date)
+    _executor.submit(_run_invoice_request, client_data, start_date, end_date, request_id)
+    logging.info(f"SAT job queued for requestId: {request_id}")
+    return request_id
+
+
+def _run_invoice_request(client_data, start_date, end_date, request_id):
+    # Only the solicitud is filed on this pool; waiting for SAT and the download run on the shared poller
+    try:
+        fetch_invoices_async(client_data, start_date, end_date, request_id=request_id).add_done_callback(
+            lambda future: _log_result(request_id, future.result())
+        )
+    except Exception as e:
+        logging.error(f"Unexpected error in SAT job {request_id}: {e}")
+        update_invoice_request(request_id, request_status='Error', progress='error', error_message=str(e))
+
+
+def _log_result(request_id, result):
+    if result.get('success'):
+        logging.info(f"SAT job {request_id} finished with {result.get('invoice_count', 0)} invoices")
+    else:
+        logging.error(f"SAT job {request_id} failed: {result.get('message')}")
@@ -0,0 +1,160 @@
+import os
+import time
+import heapq
+import logging
+import itertools
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from cfdiclient import VerificaSolicitudDescarga
+from sat_token_cache import get_sat_token, invalidate_sat_token
+
+# Delay before the first check of a new solicitud and the bounds of the adaptive backoff (seconds)
+SAT_POLL_MIN_INTERVAL = float(os.getenv('SAT_POLL_MIN_INTERVAL', '15'))
+SAT_POLL_MAX_INTERVAL = float(os.getenv('SAT_POLL_MAX_INTERVAL', '300'))
+SAT_POLL_BACKOFF = float(os.getenv('SAT_POLL_BACKOFF', '1.5'))
+# Give up on a solicitud that is still not ready after this many seconds
+SAT_POLL_TIMEOUT = float(os.getenv('SAT_POLL_TIMEOUT', str(12 * 3600)))
+# Workers that run VerificaSolicitudDescarga calls
+SAT_POLL_WORKERS = int(os.getenv('SAT_POLL_WORKERS', '4'))
+# Workers that run the on_ready callbacks (package download and processing) of ready solicitudes
+SAT_DISPATCH_WORKERS = int(os.getenv('SAT_DISPATCH_WORKERS', '4'))
+
+
+class SolicitudError(Exception):
+    """Raised through the watch() future when SAT rejects or expires a solicitud."""
+
+
+class SolicitudPoller:
+    """
+    Single scheduler for every outstanding SAT solicitud in the process.
+
+    Solicitudes are kept in a heap ordered by their next check time. Each check
+    runs on a small worker pool; while SAT reports the solicitud as accepted or
+    in progress the interval grows by SAT_POLL_BACKOFF up to SAT_POLL_MAX_INTERVAL,
+    and it drops back to the minimum whenever estado_solicitud changes. When the
+    solicitud reaches estado 3 the optional on_ready(verificacion) callback is
+    dispatched to a separate pool and its return value resolves the future.
+    """
+
+    def __init__(self, workers=SAT_POLL_WORKERS, dispatch_workers=SAT_DISPATCH_WORKERS):
+        self._heap = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='sat-poll')
+        self._dispatcher = ThreadPoolExecutor(max_workers=dispatch_workers, thread_name_prefix='sat-dispatch')
+        self._thread = None
+
+    def watch(self, fiel, rfc, id_solicitud, on_ready=None, on_progress=None):
+        entry = {
+            'fiel': fiel,
+            'rfc': rfc,
+            'id_solicitud': id_solicitud,
+            'on_ready': on_ready,
+            'on_progress': on_progress,
+            'future': Future(),
+            'interval': SAT_POLL_MIN_INTERVAL,
+            'estado': None,
+            'deadline': time.monotonic() + SAT_POLL_TIMEOUT,
+        }
+        self._schedule(entry, SAT_POLL_MIN_INTERVAL)
+        logging.info(f"Watching solicitud {id_solicitud} for RFC {rfc}")
+        return entry['future']
+
+    def pending_count(self):
+        with self._condition:
+            return len(self._heap)
+
+    def _schedule(self, entry, delay):
+        with self._condition:
+            heapq.heappush(self._heap, (time.monotonic() + delay, next(self._counter), entry))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='sat-poller', daemon=True)
+                self._thread.start()
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._heap or self._heap[0][0] > time.monotonic():
+                    timeout = self._heap[0][0] - time.monotonic() if self._heap else None
+                    self._condition.wait(timeout)
+                _, _, entry = heapq.heappop(self._heap)
+            self._executor.submit(self._check, entry)
+
+    def _check(self, entry):
+        # Anything unexpected must still resolve the future, or its waiters block forever
+        try:
+            self._verify(entry)
+        except Exception as e:
+            logging.error(f"Error checking solicitud {entry['id_solicitud']}: {e}")
+            if not entry['future'].done():
+                entry['future'].set_exception(SolicitudError(f"Error checking solicitud: {e}"))
+
+    def _verify(self, entry):
+        future = entry['future']
+        id_solicitud = entry['id_solicitud']
+        try:
+            token = get_sat_token(entry['fiel'], entry['rfc'])
+            verificacion = VerificaSolicitudDescarga(entry['fiel']).verificar_descarga(token, entry['rfc'], id_solicitud)
+            logging.info(f'Verificacion: {verificacion}')
+        except Exception as e:
+            logging.error(f"Error during verificacion_descarga for {id_solicitud}: {e}")
+            invalidate_sat_token(entry['rfc'])
+            future.set_exception(SolicitudError(f"Error during verificacion_descarga: {e}"))
+            return
+
+        cod_estatus = verificacion.get('cod_estatus')
+        if cod_estatus not in ['2000', '5000']:
+            message = verificacion.get('mensaje') or "Unknown error occurred during verification."
+            logging.error(f"Error in verificacion of {id_solicitud}: {message}")
+            future.set_exception(SolicitudError(message))
+            return
+
+        # cfdiclient leaves estado_solicitud as None when SAT omits EstadoSolicitud
+        estado_solicitud = int(verificacion.get('estado_solicitud') or 0)
+
+        if estado_solicitud <= 2:
+            if time.monotonic() > entry['deadline']:
+                future.set_exception(SolicitudError(f'Solicitud {id_solicitud} not ready after {SAT_POLL_TIMEOUT}s'))
+                return
+            if estado_solicitud == entry['estado']:
+                entry['interval'] = min(entry['interval'] * SAT_POLL_BACKOFF, SAT_POLL_MAX_INTERVAL)
+            else:
+                entry['interval'] = SAT_POLL_MIN_INTERVAL
+                if entry['on_progress']:
+                    entry['on_progress'](estado_solicitud)
+            entry['estado'] = estado_solicitud
+            logging.info(f"Solicitud {id_solicitud} in process (estado {estado_solicitud}), next check in {entry['interval']:.0f}s")
+            self._schedule(entry, entry['interval'])
+            return
+
+        if estado_solicitud >= 4:
+            future.set_exception(SolicitudError(f'Error with estado_solicitud: {estado_solicitud}'))
+            return
+
+        # estado_solicitud == 3 indicates ready for download
+        if entry['on_ready'] is None:
+            future.set_result(verificacion)
+        else:
+            self._dispatcher.submit(self._dispatch, entry, verificacion)
+
+    def _dispatch(self, entry, verificacion):
+        try:
+            entry['future'].set_result(entry['on_ready'](verificacion))
+        except Exception as e:
+            logging.error(f"Error processing ready solicitud {entry['id_solicitud']}: {e}")
+            entry['future'].set_exception(e)
+
+
+poller = SolicitudPoller()
+
+
+def watch_solicitud(fiel, rfc, id_solicitud, on_ready=None, on_progress=None):
+    """Register a solicitud with the shared poller; returns a Future."""
+    return poller.watch(fiel, rfc, id_solicitud, on_ready, on_progress)
+
+
+def wait_for_solicitud(fiel, rfc, id_solicitud):
+    """Block until the solicitud is ready and return its verificacion (raises SolicitudError)."""
+    return poller.watch(fiel, rfc, id_solicitud).result()
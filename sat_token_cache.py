@@ -0,0 +1,34 @@
+import os
+import time
+import logging
+
+from cfdiclient import Autenticacion
+from keyed_locks import KeyedLocks
+
+# SAT issues download-service tokens valid for 5 minutes
+SAT_TOKEN_TTL = float(os.getenv('SAT_TOKEN_TTL', '300'))
+# Refresh this many seconds before the token expires so in-flight calls never carry a stale token
+SAT_TOKEN_REFRESH_MARGIN = float(os.getenv('SAT_TOKEN_REFRESH_MARGIN', '30'))
+
+_tokens = {}  # rfc -> (token, expires_at)
+_lock_for = KeyedLocks()  # rfc -> Lock, so only one thread authenticates a given RFC at a time
+
+
+def get_sat_token(fiel, rfc):
+    """Return a valid SAT token for the RFC, authenticating only when the cached one is near expiry."""
+    with _lock_for(rfc):
+        cached = _tokens.get(rfc)
+        if cached and cached[1] - SAT_TOKEN_REFRESH_MARGIN > time.monotonic():
+            return cached[0]
+
+        requested_at = time.monotonic()
+        token = Autenticacion(fiel).obtener_token()
+        _tokens[rfc] = (token, requested_at + SAT_TOKEN_TTL)
+        logging.info(f'SAT token obtained for RFC {rfc}')
+        return token
+
+
+def invalidate_sat_token(rfc):
+    """Drop the cached token so the next call authenticates again (e.g. after an auth error or new e.firma)."""
+    with _lock_for(rfc):
+        _tokens.pop(rfc, None)
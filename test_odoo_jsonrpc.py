@@ -0,0 +1,77 @@
+import unittest
+
+from odoo_jsonrpc import OdooJsonRpc
+
+
+def make_bill(folio, uuid, vat='AAA010101AAA'):
+    return {
+        'partner_id': {'name': 'ACME SA DE CV', 'vat': vat},
+        'move_type': 'in_invoice',
+        'journal_id': 1,
+        'name': folio,
+        'amount_total': 116.0,
+        'folio_fiscal': uuid,
+        'invoice_date': '2024-01-15T10:00:00',
+        'invoice_line_ids': [],
+    }
+
+
+class FakeOdoo(OdooJsonRpc):
+    """OdooJsonRpc whose execute_kw answers from an in-memory account.move table."""
+
+    def __init__(self, moves=()):
+        super().__init__('http://odoo', 'db', 'user', 'password')
+        self._partners = {'AAA010101AAA': 7}
+        self.moves = list(moves)
+        self.calls = []
+
+    def execute_kw(self, model, method, args, kwargs=None):
+        self.calls.append((model, method))
+        if method == 'search_read':
+            field, _, values = args[0][1]
+            return [{'id': move['id'], field: move.get(field)} for move in self.moves if move.get(field) in values]
+        if method == 'create':
+            ids = []
+            for values in args[0]:
+                ids.append(100 + len(self.moves))
+                self.moves.append({**values, 'id': ids[-1]})
+            return ids
+        raise AssertionError(f'Unexpected call {model}.{method}')
+
+
+class CreateBillsTest(unittest.TestCase):
+    def test_bill_without_folio_is_created_next_to_an_existing_n_a_move(self):
+        odoo = FakeOdoo([{'id': 99, 'partner_id': 7, 'ref': 'N/A', 'payment_reference': 'UUID-OLD'}])
+        ids = odoo.create_bills([make_bill('N/A', 'UUID-NEW')], retry=True)
+        self.assertNotIn(99, ids)
+        self.assertEqual(len(ids), 1)
+        self.assertIn(('account.move', 'create'), odoo.calls)
+
+    def test_bills_sharing_a_folio_are_all_created(self):
+        odoo = FakeOdoo([{'id': 99, 'partner_id': 7, 'ref': 'A1', 'payment_reference': 'UUID-1'}])
+        ids = odoo.create_bills([make_bill('A1', 'UUID-2'), make_bill('A1', 'UUID-3')])
+        self.assertEqual(len(ids), 2)
+        self.assertNotIn(('account.move', 'search_read'), odoo.calls)
+
+    def test_retry_only_creates_moves_missing_by_folio_fiscal(self):
+        odoo = FakeOdoo()
+        first = odoo.create_bills([make_bill('A1', 'UUID-1')])
+        ids = odoo.create_bills([make_bill('A1', 'UUID-1'), make_bill('A2', 'UUID-2')], retry=True)
+        self.assertEqual(ids[0], first[0])
+        self.assertEqual(len(odoo.moves), 2)
+
+    def test_retry_never_matches_missing_uuids(self):
+        odoo = FakeOdoo([{'id': 99, 'partner_id': 7, 'ref': 'A1'}])
+        ids = odoo.create_bills([make_bill('A1', 'N/A')], retry=True)
+        self.assertNotIn(99, ids)
+        self.assertNotIn(('account.move', 'search_read'), odoo.calls)
+
+    def test_custom_uuid_field(self):
+        odoo = FakeOdoo([{'id': 99, 'x_uuid': 'UUID-1'}])
+        ids = odoo.create_bills([make_bill('A1', 'UUID-1')], uuid_field='x_uuid', retry=True)
+        self.assertEqual(ids, [99])
+        self.assertNotIn(('account.move', 'create'), odoo.calls)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,296 @@
+import os
+import json
+import random
+import asyncio
+import logging
+from datetime import datetime, timedelta
+
+import aiohttp
+
+from http_client import HTTP_RETRIES, HTTP_RETRY_BACKOFF
+from zoho_rate_limit import ZOHO_RATE_LIMIT_RETRIES, bucket_for, retry_delay
+from zoho_catalog import ZOHO_PAGE_SIZE, forget_rejected, item_key, lookup_item, lookup_vendor, remember_item, remember_vendor
+from zoho_utils import ZOHO_BILLS_PER_PAGE, BillIndex
+
+zoho_url = 'https://www.zohoapis.com/'
+
+# The scheduler and /checkzoho use this client; set to 0 to go back to the threaded functions
+ZOHO_ASYNC = os.getenv('ZOHO_ASYNC', '1') == '1'
+# Zoho requests in flight at once per client
+ZOHO_ASYNC_CONCURRENCY = int(os.getenv('ZOHO_ASYNC_CONCURRENCY', '20'))
+ZOHO_ASYNC_TIMEOUT = float(os.getenv('ZOHO_ASYNC_TIMEOUT', '60'))
+# Retried like http_client's sessions: 5xx, timeouts and dropped connections only for these methods
+IDEMPOTENT_METHODS = ('GET', 'PUT', 'DELETE')
+RETRY_STATUSES = (500, 502, 503, 504)
+
+
+class ZohoApiError(Exception):
+    """Raised when Zoho answers a listing with an unexpected status."""
+
+
+class AsyncZohoClient:
+    """
+    Zoho Books client for one org on aiohttp, offering the operations of
+    fetch_and_send_bills_zoho and zoho_utils as coroutines.
+
+    At most `concurrency` requests are in flight; every request also takes a token
+    from the org's bucket in zoho_rate_limit, shared with the threaded code, and
+    429 answers are retried after Retry-After or backoff. The vendor and item
+    catalogs (zoho_catalog) are consulted before the API, exactly as the
+    threaded functions do.
+
+        async with AsyncZohoClient(org_id, auth_token) as zoho:
+            matches = await zoho.reconcile(invoices, dias_tolerancia)
+    """
+
+    def __init__(self, org_id, auth_token, concurrency=ZOHO_ASYNC_CONCURRENCY):
+        self.org_id = org_id
+        self.auth_token = auth_token
+        self._concurrency = concurrency
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._bucket = bucket_for(org_id)
+        self._session = None
+
+    async def __aenter__(self):
+        self._session = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=ZOHO_ASYNC_TIMEOUT),
+            connector=aiohttp.TCPConnector(limit_per_host=self._concurrency),
+            headers={
+                'Authorization': f'Zoho-oauthtoken {self.auth_token}',
+                'X-com-zoho-books-organizationid': self.org_id,
+            },
+        )
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self._session.close()
+
+    async def request(self, method, path, params=None, json_body=None):
+        """
+        Return (status, parsed JSON body or {}) of one Zoho Books call.
+
+        429 answers are retried as in zoho_rate_limit.call_zoho. Transient failures
+        get the same HTTP_RETRIES retries as http_client's sessions: connection
+        errors for every method; timeouts, dropped connections and 5xx answers
+        only for idempotent methods, so a bill POST is never sent twice.
+        """
+        params = {**(params or {}), 'organization_id': self.org_id}
+        idempotent = method in IDEMPOTENT_METHODS
+        rate_limited = failures = 0
+        async with self._semaphore:
+            while True:
+                await self._bucket.acquire_async()
+                try:
+                    async with self._session.request(method, f"{zoho_url}books/v3/{path}", params=params, json=json_body) as response:
+                        if response.status == 429 and rate_limited + 1 < ZOHO_RATE_LIMIT_RETRIES:
+                            rate_limited += 1
+                            delay = retry_delay(response, rate_limited)
+                            logging.warning(f"Zoho rate limit hit for org {self.org_id} (attempt {rate_limited}), retrying in {delay:.1f}s")
+                            self._bucket.drain()
+                        elif response.status in RETRY_STATUSES and idempotent and failures < HTTP_RETRIES:
+                            failures += 1
+                            delay = self._backoff(failures)
+                            logging.warning(f"Zoho answered {response.status} to {method} {path} (retry {failures}), retrying in {delay:.1f}s")
+                        else:
+                            try:
+                                body = await response.json(content_type=None)
+                            except (aiohttp.ContentTypeError, json.JSONDecodeError):
+                                body = {'message': await response.text()}
+                            return response.status, body or {}
+                except aiohttp.ClientConnectorError as e:
+                    # The request never reached Zoho, so any method can be sent again
+                    if failures >= HTTP_RETRIES:
+                        raise
+                    failures += 1
+                    delay = self._backoff(failures)
+                    logging.warning(f"Could not connect to Zoho for {method} {path} (retry {failures}), retrying in {delay:.1f}s: {e}")
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    if not idempotent or failures >= HTTP_RETRIES:
+                        raise
+                    failures += 1
+                    delay = self._backoff(failures)
+                    logging.warning(f"Error calling Zoho for {method} {path} (retry {failures}), retrying in {delay:.1f}s: {e!r}")
+                await asyncio.sleep(delay)
+
+    @staticmethod
+    def _backoff(failures):
+        # urllib3's backoff_factor and backoff_jitter, as configured in http_client
+        return HTTP_RETRY_BACKOFF * 2 ** (failures - 1) + random.uniform(0, HTTP_RETRY_BACKOFF)
+
+    async def list_pages(self, path, records_key, params=None, per_page=ZOHO_PAGE_SIZE):
+        """
+        Every record of a paginated listing. Page 1 is requested alone, so a
+        listing that fits on it costs one call; only when it reports
+        has_more_page are the next pages requested in windows of concurrent
+        calls until one reports has_more_page false.
+        """
+        async def fetch(number):
+            status, body = await self.request('GET', path, {**(params or {}), 'page': number, 'per_page': per_page})
+            if status != 200:
+                raise ZohoApiError(f"Failed to list {path} in Zoho. Status Code: {status}, Response: {body}")
+            return body
+
+        body = await fetch(1)
+        records = list(body.get(records_key, []))
+        window = max(1, self._concurrency // 2)
+        page = 2
+        while body.get('page_context', {}).get('has_more_page'):
+            results = await asyncio.gather(*(fetch(number) for number in range(page, page + window)))
+            for body in results:
+                records.extend(body.get(records_key, []))
+                if not body.get('page_context', {}).get('has_more_page'):
+                    break
+            page += window
+        return records
+
+    async def list_bills(self, date_start, date_end):
+        bills = await self.list_pages('bills', 'bills', {'date_start': date_start, 'date_end': date_end}, ZOHO_BILLS_PER_PAGE)
+        logging.info(f"Fetched {len(bills)} Zoho bills from {date_start} to {date_end}")
+        return bills
+
+    async def reconcile(self, invoices, dias_tolerancia):
+        """zoho_utils.reconcile_bills: one bool per (contact_name, amount, invoice_date)."""
+        if not invoices:
+            return []
+        invoice_dates = [
+            datetime.strptime(invoice_date, '%Y-%m-%d') if isinstance(invoice_date, str) else invoice_date
+            for _, _, invoice_date in invoices
+        ]
+        tolerance = timedelta(days=dias_tolerancia)
+        index = BillIndex(await self.list_bills(
+            (min(invoice_dates) - tolerance).strftime('%Y-%m-%d'),
+            (max(invoice_dates) + tolerance).strftime('%Y-%m-%d'),
+        ))
+        return [
+            index.match(contact_name, amount, invoice_date, dias_tolerancia)
+            for (contact_name, amount, _), invoice_date in zip(invoices, invoice_dates)
+        ]
+
+    async def search_or_create_vendor(self, vendor_name, rfc=None):
+        # Catalog lookups may load from Mongo or preload from Zoho, so they run off the event loop
+        contact_id = await asyncio.to_thread(lookup_vendor, self.org_id, self.auth_token, vendor_name, rfc)
+        if contact_id:
+            return contact_id
+        try:
+            status, body = await self.request('GET', 'contacts', {'contact_name_contains': vendor_name})
+            if status != 200:
+                logging.error(f"Failed to search vendor {vendor_name} in Zoho. Status Code: {status}, Response: {body}")
+                return None
+            for contact in body.get('contacts', []):
+                if contact['contact_type'] == 'vendor':
+                    contact_id = contact['contact_id']
+                    break
+            else:
+                logging.info(f"No vendor found for {vendor_name}. Creating a new vendor contact.")
+                status, body = await self.request('POST', 'contacts', json_body={
+                    "contact_name": vendor_name + " (Vendor)",
+                    "contact_type": "vendor"
+                })
+                if status != 201:
+                    logging.error(f"Failed to create vendor {vendor_name} in Zoho. Status Code: {status}, Response: {body}")
+                    return None
+                contact_id = body['contact']['contact_id']
+            await asyncio.to_thread(remember_vendor, self.org_id, self.auth_token, vendor_name, rfc, contact_id)
+            return contact_id
+        except Exception as e:
+            logging.error(f"Error searching or creating vendor in Zoho: {e}")
+            return None
+
+    async def search_or_create_item(self, item_name):
+        item_name = item_key(item_name)
+        try:
+            item = await asyncio.to_thread(lookup_item, self.org_id, self.auth_token, item_name)
+            if item is None:
+                status, body = await self.request('GET', 'items', {'name_startswith': item_name})
+                if status != 200:
+                    logging.error(f"Failed to search item {item_name} in Zoho. Status Code: {status}, Response: {body}")
+                    return None
+                items = body.get('items', [])
+                if items:
+                    item = {'item_id': items[0]['item_id'], 'item_type': items[0]['item_type']}
+                    await asyncio.to_thread(remember_item, self.org_id, self.auth_token, item_name, item['item_id'], item['item_type'])
+
+            if item is None:
+                status, body = await self.request('POST', 'items', json_body={
+                    "name": item_name,
+                    "item_type": "sales_and_purchases",
+                    "rate": 0  # Placeholder rate, can be adjusted later
+                })
+                if status != 201:
+                    logging.error(f"Failed to create item {item_name} in Zoho. Status Code: {status}, Response: {body}")
+                    return None
+                item_id = body['item']['item_id']
+                await asyncio.to_thread(remember_item, self.org_id, self.auth_token, item_name, item_id, 'sales_and_purchases')
+                return item_id
+
+            if item['item_type'] == 'sales':
+                status, body = await self.request('PUT', f"items/{item['item_id']}", json_body={"item_type": "sales_and_purchases"})
+                if status == 200:
+                    logging.info(f"Item {item_name} updated to sales_and_purchases")
+                    await asyncio.to_thread(remember_item, self.org_id, self.auth_token, item_name, item['item_id'], 'sales_and_purchases')
+                else:
+                    logging.error(f"Failed to update item {item_name} to sales_and_purchases. Status Code: {status}, Response: {body}")
+            return item['item_id']
+        except Exception as e:
+            logging.error(f"Error searching or creating item in Zoho: {e}")
+            return None
+
+    async def resolve_vendors(self, cfdis):
+        """{emisor rfc: contact_id} for the distinct emisores of a solicitud, resolved concurrently."""
+        emisores = {cfdi['emisor_rfc']: cfdi['emisor_nombre'] for cfdi in cfdis}
+        contact_ids = await asyncio.gather(*(
+            self.search_or_create_vendor(vendor_name, rfc) for rfc, vendor_name in emisores.items()
+        ))
+        return dict(zip(emisores, contact_ids))
+
+    async def resolve_items(self, cfdis):
+        """{truncated name: item_id} for the distinct concepto descriptions of a solicitud, resolved concurrently."""
+        names = list({item_key(concepto['descripcion']) for cfdi in cfdis for concepto in cfdi['conceptos']})
+        item_ids = await asyncio.gather(*(self.search_or_create_item(name) for name in names))
+        return dict(zip(names, item_ids))
+
+    async def send_bill(self, invoice_data):
+        try:
+            status, body = await self.request('POST', 'bills', json_body=invoice_data)
+            if status == 201:
+                logging.info(f"Invoice {invoice_data['bill_number']} sent successfully to Zoho.")
+                return True
+            logging.error(f"Failed to send invoice {invoice_data['bill_number']} to Zoho. Status Code: {status}, Response: {body}")
+            if status == 400:
+                # A cached vendor, item or tax deleted in Zoho must not be sent again
+                await asyncio.to_thread(forget_rejected, self.org_id, self.auth_token, invoice_data, body.get('message'))
+        except Exception as e:
+            logging.error(f"Error sending invoice to Zoho: {e}")
+        return False
+
+    async def send_bills(self, bills):
+        """Post all bills concurrently. Returns (sent, failed)."""
+        results = await asyncio.gather(*(self.send_bill(bill) for bill in bills))
+        sent = sum(results)
+        logging.info(f"Sent {sent} of {len(bills)} bills to Zoho org {self.org_id}")
+        return sent, len(bills) - sent
+
+
+def reconcile_bills_async(invoices, org_id, auth_token, dias_tolerancia):
+    """Blocking entry point for Flask handlers: AsyncZohoClient.reconcile on a private event loop."""
+    async def run():
+        async with AsyncZohoClient(org_id, auth_token) as zoho:
+            return await zoho.reconcile(invoices, dias_tolerancia)
+    return asyncio.run(run())
+
+
+def push_bills_async(cfdis, org_id, auth_token, build_bill):
+    """
+    Blocking entry point for the scheduler: resolve the vendors and items of a
+    solicitud, build each bill with build_bill(cfdi, item_ids, vendor_ids) in a
+    worker thread (tax lookups are synchronous) and post the bills, all on one
+    event loop. Returns (sent, failed).
+    """
+    async def run():
+        async with AsyncZohoClient(org_id, auth_token) as zoho:
+            vendor_ids, item_ids = await asyncio.gather(zoho.resolve_vendors(cfdis), zoho.resolve_items(cfdis))
+            bills = await asyncio.to_thread(
+                lambda: [bill for bill in (build_bill(cfdi, item_ids, vendor_ids) for cfdi in cfdis) if bill]
+            )
+            return await zoho.send_bills(bills)
+    return asyncio.run(run())
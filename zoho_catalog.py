@@ -0,0 +1,328 @@
+import os
+import logging
+import threading
+from datetime import datetime, timedelta
+
+import http_client
+from pymongo import ASCENDING, UpdateOne
+from db import db
+from zoho_utils import vendor_name_key
+from zoho_rate_limit import call_zoho
+from cfdi_parser import TAX_NAMES, tax_name
+
+zoho_url = 'https://www.zohoapis.com/'
+
+# Entries per org and kind ('vendor', ...) that survive restarts
+zoho_catalog_collection = db['zoho_catalog']
+
+# Days before an org's catalog is preloaded again from Zoho, picking up records created outside this app
+ZOHO_CATALOG_REFRESH_DAYS = float(os.getenv('ZOHO_CATALOG_REFRESH_DAYS', '7'))
+# Records requested per page from Zoho list endpoints (Zoho's maximum)
+ZOHO_PAGE_SIZE = 200
+
+# Key of the document recording when an org's catalog was last preloaded; never an entry
+PRELOAD_MARKER = '__preloaded__'
+# Phrases of a Zoho error message saying a referenced record is gone,
+# e.g. "Vendor does not exist." or "Invalid value passed for vendor_id"
+DEAD_RECORD_PHRASES = ('does not exist', 'invalid value', 'not found', 'deleted', 'inactive')
+
+_indexes_ready = False
+_indexes_lock = threading.Lock()
+
+
+def _ensure_indexes():
+    global _indexes_ready
+    with _indexes_lock:
+        if not _indexes_ready:
+            zoho_catalog_collection.create_index(
+                [('org_id', ASCENDING), ('kind', ASCENDING), ('key', ASCENDING)],
+                name='org_kind_key_unique',
+                unique=True,
+            )
+            _indexes_ready = True
+
+
+def fetch_zoho_pages(path, records_key, org_id, auth_token, params=None):
+    """Yield every record of a paginated Zoho Books list endpoint, following page_context."""
+    headers = {
+        'Authorization': f'Zoho-oauthtoken {auth_token}',
+        'X-com-zoho-books-organizationid': org_id
+    }
+    page = 1
+    while True:
+        page_params = {**(params or {}), 'organization_id': org_id, 'page': page, 'per_page': ZOHO_PAGE_SIZE}
+        response = call_zoho(org_id, lambda: http_client.get(f"{zoho_url}books/v3/{path}", headers=headers, params=page_params))
+        if response.status_code != 200:
+            raise Exception(f"Failed to list {path} in Zoho. Status Code: {response.status_code}, Response: {response.text}")
+        data = response.json()
+        yield from data.get(records_key, [])
+        if not data.get('page_context', {}).get('has_more_page'):
+            return
+        page += 1
+
+
+class OrgCatalog:
+    """The entries of one org and kind, held in memory and written through to zoho_catalog."""
+
+    def __init__(self, org_id, kind, entries=None):
+        self.org_id = org_id
+        self.kind = kind
+        self._entries = entries or {}
+        self._lock = threading.Lock()
+        self._create_lock = threading.Lock()
+        self.loaded_at = datetime.utcnow()
+
+    def get(self, key):
+        return self._entries.get(key)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get_or_create(self, key, create):
+        """
+        Return the entry for key, calling create() to make it when missing. Creation is
+        serialized per org and kind, so concurrent misses create the Zoho record once;
+        a None result is not stored.
+        """
+        value = self._entries.get(key)
+        if value is not None:
+            return value
+        with self._create_lock:
+            value = self._entries.get(key)
+            if value is None:
+                value = create()
+                if value is not None:
+                    self.put({key: value})
+            return value
+
+    def forget_ids(self, ids, id_of=lambda value: value):
+        """Drop the entries whose value (or id_of(value)) is one of ids, in memory and in Mongo."""
+        with self._lock:
+            keys = [key for key, value in self._entries.items() if id_of(value) in ids]
+            for key in keys:
+                del self._entries[key]
+        if not keys:
+            return
+        logging.info(f"Forgot {len(keys)} Zoho {self.kind} entries of org {self.org_id} rejected by Zoho")
+        try:
+            zoho_catalog_collection.delete_many({'org_id': self.org_id, 'kind': self.kind, 'key': {'$in': keys}})
+        except Exception as e:
+            logging.error(f"Error removing Zoho {self.kind} catalog entries for org {self.org_id}: {e}")
+
+    def replace(self, entries):
+        """
+        Make entries the whole catalog: keys missing from it (records deleted or
+        renamed in Zoho) are dropped in memory and in Mongo. Documents written
+        since the call started, e.g. by another process, are kept.
+        """
+        started = datetime.utcnow()
+        with self._lock:
+            self._entries = dict(entries)
+        self.put(entries)
+        try:
+            zoho_catalog_collection.delete_many({
+                'org_id': self.org_id,
+                'kind': self.kind,
+                'key': {'$ne': PRELOAD_MARKER},
+                'updated_at': {'$lt': started},
+            })
+        except Exception as e:
+            logging.error(f"Error pruning Zoho {self.kind} catalog for org {self.org_id}: {e}")
+
+    def mark_preloaded(self):
+        """Record the time of this preload in its own document, outside the entries."""
+        try:
+            zoho_catalog_collection.update_one(
+                {'org_id': self.org_id, 'kind': self.kind, 'key': PRELOAD_MARKER},
+                {'$set': {'updated_at': datetime.utcnow()}, '$unset': {'value': ''}},
+                upsert=True,
+            )
+        except Exception as e:
+            logging.error(f"Error recording Zoho {self.kind} preload for org {self.org_id}: {e}")
+
+    def put(self, entries):
+        """Add or replace {key: value} entries in memory and in Mongo."""
+        if not entries:
+            return
+        with self._lock:
+            self._entries.update(entries)
+        now = datetime.utcnow()
+        try:
+            zoho_catalog_collection.bulk_write([
+                UpdateOne(
+                    {'org_id': self.org_id, 'kind': self.kind, 'key': key},
+                    {'$set': {'value': value, 'updated_at': now}},
+                    upsert=True,
+                )
+                for key, value in entries.items()
+            ], ordered=False)
+        except Exception as e:
+            # The in-memory entries still serve this process
+            logging.error(f"Error persisting Zoho {self.kind} catalog for org {self.org_id}: {e}")
+
+
+class ZohoCatalog:
+    """
+    Per-org catalogs of one kind of Zoho record.
+
+    The first use of an org in a process loads its entries from Mongo. When the
+    org was never preloaded, or the last preload is older than refresh_days
+    (ZOHO_CATALOG_REFRESH_DAYS by default), preload(org_id, auth_token) lists
+    the records from Zoho once and returns {key: value}, which replaces the
+    stored entries. Lookups after that never touch the API; callers put() what
+    they create and forget_ids() what Zoho rejects. A process that outlives
+    refresh_days loads the org again on its next use.
+    """
+
+    def __init__(self, kind, preload, refresh_days=ZOHO_CATALOG_REFRESH_DAYS):
+        self.kind = kind
+        self._preload = preload
+        self._refresh = timedelta(days=refresh_days)
+        self._orgs = {}  # org_id -> OrgCatalog
+        self._org_locks = {}  # org_id -> Lock, so one org's preload does not hold up the others
+        self._lock = threading.Lock()
+
+    def _fresh(self, catalog):
+        return catalog is not None and datetime.utcnow() - catalog.loaded_at <= self._refresh
+
+    def for_org(self, org_id, auth_token):
+        catalog = self._orgs.get(org_id)
+        if self._fresh(catalog):
+            return catalog
+        with self._lock:
+            org_lock = self._org_locks.setdefault(org_id, threading.Lock())
+        with org_lock:
+            catalog = self._orgs.get(org_id)
+            if not self._fresh(catalog):
+                catalog = self._orgs[org_id] = self._load(org_id, auth_token)
+            return catalog
+
+    def _load(self, org_id, auth_token):
+        entries = {}
+        preloaded_at = None
+        try:
+            _ensure_indexes()
+            for document in zoho_catalog_collection.find({'org_id': org_id, 'kind': self.kind}):
+                if document['key'] == PRELOAD_MARKER:
+                    preloaded_at = document.get('updated_at')
+                else:
+                    entries[document['key']] = document.get('value')
+        except Exception as e:
+            logging.error(f"Error loading Zoho {self.kind} catalog for org {org_id}: {e}")
+        catalog = OrgCatalog(org_id, self.kind, entries)
+
+        if preloaded_at is None or datetime.utcnow() - preloaded_at > self._refresh:
+            try:
+                preloaded = self._preload(org_id, auth_token)
+                catalog.replace(preloaded)
+                catalog.mark_preloaded()
+                logging.info(f"Preloaded {len(preloaded)} Zoho {self.kind} entries for org {org_id}")
+            except Exception as e:
+                # Lookups fall back to the Zoho search API until the next process retries
+                logging.error(f"Error preloading Zoho {self.kind} catalog for org {org_id}: {e}")
+        return catalog
+
+
+def vendor_rfc_key(rfc):
+    return f"rfc:{rfc.strip().upper()}"
+
+
+def _preload_vendors(org_id, auth_token):
+    vendors = {}
+    for contact in fetch_zoho_pages('contacts', 'contacts', org_id, auth_token, {'contact_type': 'vendor'}):
+        vendors.setdefault(vendor_name_key(contact['contact_name']), contact['contact_id'])
+    return vendors
+
+
+zoho_vendors = ZohoCatalog('vendor', _preload_vendors)
+
+
+def forget_rejected(org_id, auth_token, bill, message):
+    """
+    Drop the cached records a rejected bill referenced when Zoho's error message
+    says one of them no longer exists, so the next bill searches for them again.
+    """
+    message = (message or '').lower()
+    if not any(phrase in message for phrase in DEAD_RECORD_PHRASES):
+        return
+    if 'vendor' in message or 'contact' in message:
+        # build_zoho_bill sends the vendor's contact_id under 'rfc'
+        zoho_vendors.for_org(org_id, auth_token).forget_ids({bill.get('rfc')})
+    if 'item' in message:
+        item_ids = {line.get('item_id') for line in bill.get('line_items', [])}
+        zoho_items.for_org(org_id, auth_token).forget_ids(item_ids, id_of=lambda item: item['item_id'])
+    if 'tax' in message:
+        tax_ids = {line.get('tax_id') for line in bill.get('line_items', [])}
+        tax_ids.update(tax.get('tax_id') for tax in bill.get('taxes', []))
+        zoho_taxes.for_org(org_id, auth_token).forget_ids(tax_ids)
+
+
+def lookup_vendor(org_id, auth_token, vendor_name, rfc=None):
+    """contact_id of the vendor with this RFC or normalized name, or None when it is not cached."""
+    vendors = zoho_vendors.for_org(org_id, auth_token)
+    if rfc:
+        contact_id = vendors.get(vendor_rfc_key(rfc))
+        if contact_id:
+            return contact_id
+    return vendors.get(vendor_name_key(vendor_name))
+
+
+def remember_vendor(org_id, auth_token, vendor_name, rfc, contact_id):
+    entries = {vendor_name_key(vendor_name): contact_id}
+    if rfc:
+        entries[vendor_rfc_key(rfc)] = contact_id
+    zoho_vendors.for_org(org_id, auth_token).put(entries)
+
+
+# Zoho item names are limited to 99 characters; items are created and looked up by the truncated name
+ZOHO_ITEM_NAME_LENGTH = 99
+
+
+def item_key(item_name):
+    return item_name[:ZOHO_ITEM_NAME_LENGTH]
+
+
+def _preload_items(org_id, auth_token):
+    items = {}
+    for item in fetch_zoho_pages('items', 'items', org_id, auth_token):
+        items.setdefault(item_key(item['name']), {'item_id': item['item_id'], 'item_type': item.get('item_type')})
+    return items
+
+
+zoho_items = ZohoCatalog('item', _preload_items)
+
+
+def lookup_item(org_id, auth_token, item_name):
+    """{'item_id', 'item_type'} of the cached item with this (truncated) name, or None."""
+    return zoho_items.for_org(org_id, auth_token).get(item_key(item_name))
+
+
+def remember_item(org_id, auth_token, item_name, item_id, item_type):
+    zoho_items.for_org(org_id, auth_token).put({item_key(item_name): {'item_id': item_id, 'item_type': item_type}})
+
+
+# Days the tax registry of an org is trusted before the taxes are listed from Zoho again
+ZOHO_TAX_REFRESH_DAYS = float(os.getenv('ZOHO_TAX_REFRESH_DAYS', '1'))
+# Tax kinds as named by cfdi_parser.tax_name, recognized inside Zoho tax names such as "IVA 16%"
+TAX_KINDS = tuple(TAX_NAMES.values()) + (tax_name('999'),)
+
+
+def tax_key(tax_kind, tax_percentage):
+    return f"{tax_kind}:{round(float(tax_percentage), 2):.2f}"
+
+
+def _preload_taxes(org_id, auth_token):
+    taxes = {}
+    for tax in fetch_zoho_pages('settings/taxes', 'taxes', org_id, auth_token):
+        for tax_kind in TAX_KINDS:
+            if tax_kind in tax.get('tax_name', ''):
+                taxes.setdefault(tax_key(tax_kind, tax.get('tax_percentage', 0)), tax['tax_id'])
+    return taxes
+
+
+zoho_taxes = ZohoCatalog('tax', _preload_taxes, refresh_days=ZOHO_TAX_REFRESH_DAYS)
+
+
+def get_or_create_tax(org_id, auth_token, tax_kind, tax_percentage, create):
+    """tax_id registered for (tax kind, rounded percentage), calling create() once when there is none."""
+    return zoho_taxes.for_org(org_id, auth_token).get_or_create(tax_key(tax_kind, tax_percentage), create)
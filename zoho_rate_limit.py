@@ -0,0 +1,95 @@
+import os
+import time
+import asyncio
+import random
+import logging
+import threading
+
+# Zoho Books allows 100 API calls per minute per organization
+ZOHO_REQUESTS_PER_MINUTE = float(os.getenv('ZOHO_REQUESTS_PER_MINUTE', '100'))
+# Calls an org may make back to back before the refill rate applies
+ZOHO_BURST = int(os.getenv('ZOHO_BURST', '10'))
+# Attempts of a call answered with 429 before its response is returned as is
+ZOHO_RATE_LIMIT_RETRIES = int(os.getenv('ZOHO_RATE_LIMIT_RETRIES', '5'))
+ZOHO_RATE_LIMIT_BACKOFF = float(os.getenv('ZOHO_RATE_LIMIT_BACKOFF', '2'))
+
+
+class TokenBucket:
+    """Blocking token bucket: acquire() takes one token, waiting for the refill when the bucket is empty."""
+
+    def __init__(self, rate_per_second, capacity):
+        self.rate = rate_per_second
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """Take a token if one is available and return 0, else return the seconds until one is."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            return (1 - self._tokens) / self.rate
+
+    def acquire(self):
+        while True:
+            wait = self.reserve()
+            if not wait:
+                return
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        """acquire() for coroutines: waits on the event loop instead of blocking the thread."""
+        while True:
+            wait = self.reserve()
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+    def drain(self):
+        """Empty the bucket after the server said the limit was hit, so every caller waits for the refill."""
+        with self._lock:
+            self._tokens = 0
+            self._updated = time.monotonic()
+
+
+_buckets = {}  # org_id -> TokenBucket
+_buckets_lock = threading.Lock()
+
+
+def bucket_for(org_id):
+    with _buckets_lock:
+        bucket = _buckets.get(org_id)
+        if bucket is None:
+            bucket = _buckets[org_id] = TokenBucket(ZOHO_REQUESTS_PER_MINUTE / 60, ZOHO_BURST)
+        return bucket
+
+
+def retry_delay(response, attempt):
+    """Seconds to wait before retrying a 429: Retry-After when Zoho sends it, else backoff with jitter."""
+    try:
+        return float(response.headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        # Exponential backoff with jitter so the org's workers do not retry in lockstep
+        return ZOHO_RATE_LIMIT_BACKOFF * 2 ** (attempt - 1) * (1 + random.random())
+
+
+def call_zoho(org_id, send):
+    """
+    Run send() (one Zoho API call returning a response) under the org's token
+    bucket, retrying with backoff while Zoho answers 429.
+    """
+    bucket = bucket_for(org_id)
+    for attempt in range(1, ZOHO_RATE_LIMIT_RETRIES + 1):
+        bucket.acquire()
+        response = send()
+        if response.status_code != 429 or attempt == ZOHO_RATE_LIMIT_RETRIES:
+            return response
+        delay = retry_delay(response, attempt)
+        logging.warning(f"Zoho rate limit hit for org {org_id} (attempt {attempt}), retrying in {delay:.1f}s")
+        bucket.drain()
+        time.sleep(delay)
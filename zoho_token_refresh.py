@@ -1,60 +1,130 @@
 # zoho_token_refresh.py
 
-import requests
+import os
+import time
+import http_client
 import logging
 from datetime import datetime, timedelta
+from keyed_locks import KeyedLocks
 
 zoho_url = 'https://www.zohoapis.com/'
 
-def refresh_zoho_token(client_data, db_collection):
+# Zoho access tokens last an hour; used when the token response carries no expires_in
+ZOHO_TOKEN_DEFAULT_TTL = int(os.getenv('ZOHO_TOKEN_DEFAULT_TTL', '3600'))
+# Seconds before expiry at which the token is replaced; a bill sync started on a token about
+# to expire would otherwise see its later Zoho calls answered with 401
+ZOHO_TOKEN_REFRESH_MARGIN = int(os.getenv('ZOHO_TOKEN_REFRESH_MARGIN', '300'))
+# Seconds another process may hold the refresh of a client before this one takes over
+ZOHO_TOKEN_LEASE_SECONDS = int(os.getenv('ZOHO_TOKEN_LEASE_SECONDS', '30'))
+
+_tokens = {}  # rfc -> (token, expires_at UTC)
+_lock_for = KeyedLocks()  # rfc -> Lock, so only one thread refreshes a given client at a time
+
+
+def _usable(expires_at):
+    return expires_at is not None and expires_at - timedelta(seconds=ZOHO_TOKEN_REFRESH_MARGIN) > datetime.utcnow()
+
+
+def _stored_token(rfc, db_collection):
+    """(token, expires_at) as last written to the client document by any process."""
+    stored = db_collection.find_one({'rfc': rfc}, {'authtoken': 1, 'token_expires_at': 1}) or {}
+    return stored.get('authtoken'), stored.get('token_expires_at')
+
+
+def _take_lease(rfc, db_collection):
+    """Claim the refresh of this client across processes; False while another process holds it."""
+    now = datetime.utcnow()
+    claimed = db_collection.update_one(
+        {'rfc': rfc, '$or': [
+            {'token_refresh_lease': {'$exists': False}},
+            {'token_refresh_lease': {'$lt': now}},
+        ]},
+        {'$set': {'token_refresh_lease': now + timedelta(seconds=ZOHO_TOKEN_LEASE_SECONDS)}}
+    )
+    return claimed.modified_count == 1
+
+
+def _wait_for_other_refresh(rfc, db_collection):
+    """Poll the client document while another process refreshes; (token, expires_at) or (None, None)."""
+    deadline = time.monotonic() + ZOHO_TOKEN_LEASE_SECONDS
+    while time.monotonic() < deadline:
+        time.sleep(1)
+        token, expires_at = _stored_token(rfc, db_collection)
+        if _usable(expires_at):
+            return token, expires_at
+    return None, None
+
+
+def _request_token(client_data, db_collection):
+    """
+    Exchange the refresh token at accounts.zoho.com and store the result; returns
+    (token, expires_at). The refresh lease is released whether or not it succeeds,
+    so other processes never wait out a failed refresh.
+    """
+    rfc = client_data['rfc']
+    logging.info(f'Refreshing Zoho token for client {rfc}...')
+    # Prepare the token refresh request
+    refresh_payload = {
+        'refresh_token': client_data['refresh_token'],
+        'client_id': client_data['client_id'],
+        'client_secret': client_data['client_secret'],
+        'grant_type': 'refresh_token',
+        'redirect_uri': 'https://zoho.com'  # Replace with actual redirect URI if needed
+    }
     try:
-        # Initialize auth_token
-        auth_token = client_data.get('authtoken', None)
-        
-        # Extract relevant data from client_data
-        refresh_token = client_data['refresh_token']
-        client_id = client_data['client_id']
-        client_secret = client_data['client_secret']
-        last_refresh_time = client_data.get('last_refresh_time', datetime.min)
-        
-        # Calculate the time difference
-        current_time = datetime.now()
-        time_difference = current_time - last_refresh_time
-
-        if time_difference > timedelta(hours=1):
-            logging.info(f'Token for client {client_data["rfc"]} is older than 1 hour, refreshing token...')
-            # Prepare the token refresh request
-            refresh_payload = {
-                'refresh_token': refresh_token,
-                'client_id': client_id,
-                'client_secret': client_secret,
-                'grant_type': 'refresh_token',
-                'redirect_uri': 'https://zoho.com'  # Replace with actual redirect URI if needed
+        requested_at = datetime.utcnow()
+        response = http_client.post('https://accounts.zoho.com/oauth/v2/token', data=refresh_payload)
+        new_token_data = response.json() if response.status_code == 200 else {}
+        auth_token = new_token_data.get('access_token')
+        if not auth_token:
+            raise Exception(f'Failed to refresh Zoho token for client {rfc}. Status Code: {response.status_code}, Response: {response.text}')
+
+        expires_at = requested_at + timedelta(seconds=int(new_token_data.get('expires_in', ZOHO_TOKEN_DEFAULT_TTL)))
+        logging.info(f'New access token obtained for client {rfc}, valid until {expires_at} UTC')
+
+        # Update the database with the new token so other processes reuse it
+        db_collection.update_one(
+            {'rfc': rfc},
+            {
+                '$set': {
+                    'authtoken': auth_token,
+                    'token_expires_at': expires_at,
+                    'last_refresh_time': datetime.now()
+                }
             }
+        )
+        return auth_token, expires_at
+    finally:
+        db_collection.update_one({'rfc': rfc}, {'$unset': {'token_refresh_lease': ''}})
+
+
+def get_zoho_token(client_data, db_collection):
+    """
+    Return a valid Zoho access token for the client, refreshing ahead of expiry.
 
-            response = requests.post(f'https://accounts.zoho.com/oauth/v2/token', data=refresh_payload)
-
-            if response.status_code == 200:
-                new_token_data = response.json()
-                auth_token = new_token_data.get('access_token')
-                logging.info(f'New access token obtained for client {client_data["rfc"]}: {auth_token}')
-
-                # Update the database with the new token and refresh time
-                db_collection.update_one(
-                    {'rfc': client_data['rfc']},
-                    {'$set': {
-                        'authtoken': auth_token,
-                        'last_refresh_time': current_time
-                    }}
-                )
-            else:
-                logging.error(f'Failed to refresh Zoho token for client {client_data["rfc"]}. Status Code: {response.status_code}, Response: {response.text}')
-        else:
-            logging.info(f'Token for client {client_data["rfc"]} is still valid.')
-
-        # Return the token and the last refresh time
-        return auth_token, current_time
-
-    except Exception as e:
-        logging.error(f'Error refreshing Zoho token for client {client_data["rfc"]}: {e}')
-        return auth_token, last_refresh_time
+    Tokens are cached in memory per RFC until ZOHO_TOKEN_REFRESH_MARGIN seconds
+    before the expires_in Zoho reported. One thread per client refreshes while
+    the others wait for its result, and the client document is the shared store:
+    a token another process already refreshed is reused, and a lease on the
+    document keeps two processes from refreshing the same client at once. When
+    the refresh fails the last known token is returned, as before.
+    """
+    rfc = client_data['rfc']
+    with _lock_for(rfc):
+        token, expires_at = _tokens.get(rfc, (None, None))
+        if _usable(expires_at):
+            return token
+        try:
+            token, expires_at = _stored_token(rfc, db_collection)
+            if not _usable(expires_at):
+                if _take_lease(rfc, db_collection):
+                    token, expires_at = _request_token(client_data, db_collection)
+                else:
+                    token, expires_at = _wait_for_other_refresh(rfc, db_collection)
+                    if token is None:
+                        token, expires_at = _request_token(client_data, db_collection)
+            _tokens[rfc] = (token, expires_at)
+            return token
+        except Exception as e:
+            logging.error(f'Error refreshing Zoho token for client {rfc}: {e}')
+            return token or client_data.get('authtoken')
@@ -1,58 +1,113 @@
-import requests
+import http_client
 import logging
 from datetime import datetime, timedelta
+from zoho_rate_limit import call_zoho
 
 
-def check_bill_in_zoho(rfc, contact_name, amount, invoice_date, org_id, auth_token, zoho_url, dias_tolerancia):
+# Bills requested per page from the Zoho bills list (Zoho's maximum)
+ZOHO_BILLS_PER_PAGE = 200
 
+
+def normalize_vendor_name(name):
+    """Case- and whitespace-insensitive vendor name used as a matching key."""
+    return ' '.join((name or '').split()).casefold()
+
+
+def vendor_name_key(vendor_name):
+    # Vendors created by search_or_create_vendor are named "<emisor> (Vendor)"
+    name = normalize_vendor_name(vendor_name)
+    if name.endswith(' (vendor)'):
+        name = name[:-len(' (vendor)')]
+    return f'name:{name}'
+
+
+def fetch_zoho_bills(org_id, auth_token, date_start, date_end):
+    """
+    Fetch every bill of the organization dated between date_start and date_end
+    (YYYY-MM-DD, inclusive), following Zoho's page_context until has_more_page
+    is false. Raises on a failed page so a partial list is never matched against.
+    """
     headers = {
-        'Content-Type': 'application/json',
         'Authorization': f'Zoho-oauthtoken {auth_token}',
         'X-com-zoho-books-organizationid': org_id
     }
+    bills = []
+    page = 1
+    while True:
+        params = {
+            'organization_id': org_id,
+            'date_start': date_start,
+            'date_end': date_end,
+            'page': page,
+            'per_page': ZOHO_BILLS_PER_PAGE,
+        }
+        response = call_zoho(org_id, lambda: http_client.get("https://www.zohoapis.com/books/v3/bills", headers=headers, params=params))
+        if response.status_code != 200:
+            raise Exception(f"Failed to list bills in Zoho. Status Code: {response.status_code}, Response: {response.text}")
+        data = response.json()
+        bills.extend(data.get('bills', []))
+        if not data.get('page_context', {}).get('has_more_page'):
+            break
+        page += 1
+    logging.info(f"Fetched {len(bills)} Zoho bills from {date_start} to {date_end} in {page} page(s)")
+    return bills
+
+
+class BillIndex:
+    """
+    Zoho bills indexed by (vendor_name_key, amount in cents), each key
+    holding the sorted bill dates, so an invoice is matched with a dict lookup
+    and a scan of the few bills of that vendor and amount.
+    """
 
-    try:
-        # Search for a bill that matches the contact_name (vendor_name) and amount
-        response = requests.get(
-            f"https://www.zohoapis.com/books/v3/bills?organization_id={org_id}&contact_name={contact_name}&total={amount}",
-            headers=headers
-        )
-        
-        if response.status_code == 200:
-            bills = response.json().get('bills', [])
-            if bills:
-                for bill in bills:
-                    # Extract the bill date and convert it to datetime object
-                    bill_date_str = bill.get('date')
-                    if bill_date_str:
-                        bill_date = datetime.strptime(bill_date_str, '%Y-%m-%d')
-
-                        # Convert the invoice_date to datetime object if it’s a string
-                        if isinstance(invoice_date, str):
-                            invoice_date = datetime.strptime(invoice_date, '%Y-%m-%d')
-
-                        # Calculate the difference between the invoice date and bill date
-                        date_difference = abs((invoice_date - bill_date).days)
-
-                        if date_difference <= dias_tolerancia:
-                            logging.info(
-                                f"Matching bill found for contact_name {contact_name} with amount {amount} "
-                                f"and date difference {date_difference} days."
-                            )
-                            return True  # Matching bill within the date tolerance
-
-                # No matching bill found within the date tolerance
-                logging.info(
-                    f"No matching bill found for contact_name {contact_name} with amount {amount} within {dias_tolerancia} days."
-                )
-                return False
-            else:
-                # No matching bill found at all
-                logging.info(f"No matching bill found for contact_name {contact_name} with amount {amount}.")
-                return False
-        else:
-            logging.error(f"Failed to search for bills in Zoho. Status Code: {response.status_code}, Response: {response.text}")
-            return False
-    except Exception as e:
-        logging.error(f"Error checking bill in Zoho: {e}")
+    def __init__(self, bills):
+        self._dates = {}
+        for bill in bills:
+            bill_date_str = bill.get('date')
+            if not bill_date_str:
+                continue
+            key = self.key(bill.get('vendor_name'), bill.get('total', 0))
+            self._dates.setdefault(key, []).append(datetime.strptime(bill_date_str, '%Y-%m-%d'))
+        for dates in self._dates.values():
+            dates.sort()
+
+    @staticmethod
+    def key(contact_name, amount):
+        return vendor_name_key(contact_name), round(float(amount) * 100)
+
+    def match(self, contact_name, amount, invoice_date, dias_tolerancia):
+        """True when a bill of the vendor and amount is dated within dias_tolerancia days of invoice_date."""
+        if isinstance(invoice_date, str):
+            invoice_date = datetime.strptime(invoice_date, '%Y-%m-%d')
+        for bill_date in self._dates.get(self.key(contact_name, amount), ()):
+            if abs((invoice_date - bill_date).days) <= dias_tolerancia:
+                return True
         return False
+
+
+def reconcile_bills(invoices, org_id, auth_token, dias_tolerancia):
+    """
+    Match (contact_name, amount, invoice_date) tuples against the org's Zoho bills
+    and return one bool per invoice, in order.
+
+    Instead of one bills search per invoice, the bills dated within the invoices'
+    date range widened by the tolerance are listed in a few paginated calls and
+    indexed with BillIndex; every invoice is then matched locally.
+    """
+    if not invoices:
+        return []
+    invoice_dates = [
+        datetime.strptime(invoice_date, '%Y-%m-%d') if isinstance(invoice_date, str) else invoice_date
+        for _, _, invoice_date in invoices
+    ]
+    tolerance = timedelta(days=dias_tolerancia)
+    date_start = (min(invoice_dates) - tolerance).strftime('%Y-%m-%d')
+    date_end = (max(invoice_dates) + tolerance).strftime('%Y-%m-%d')
+
+    index = BillIndex(fetch_zoho_bills(org_id, auth_token, date_start, date_end))
+    matches = [
+        index.match(contact_name, amount, invoice_date, dias_tolerancia)
+        for (contact_name, amount, _), invoice_date in zip(invoices, invoice_dates)
+    ]
+    logging.info(f"{sum(matches)} of {len(matches)} invoices matched a Zoho bill")
+    return matches